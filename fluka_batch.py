@@ -0,0 +1,188 @@
+import os
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import numpy as np
+from fluka_data import say, get_usrbins, wall_thickness
+
+
+# pSv/primary to Sv/h of the vault runs, see vault_analysis.py
+DEFAULT_CONFIG = {
+    'norm': (1.2E+5 / 4.0E+7) * 6.2415E+18 * 1.0E-12 * 3600,
+    'target_dose': 5.0E-5,
+    # wall name: (axis, coordinate of the inner face, cm)
+    'walls': {'X': [0, 203.0], 'Z': [2, 861.0]},
+    # mirror planes (axes) and 'sum' or 'mean', see USRBINBase.set_symmetry
+    'symmetry': [[2], 'sum'],
+    # dose planes (axis, index) saved for every detector
+    'slices': [[1, 4]],
+    'detectors': None,
+    'plots': True,
+}
+
+MANIFEST = 'manifest.json'
+SUMMARY = 'summary.csv'
+
+
+def load_config(fn=None):
+    config = dict(DEFAULT_CONFIG)
+    if fn is not None:
+        with open(fn) as f:
+            config.update(json.load(f))
+    return config
+
+
+def file_hash(fn):
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def analyse(fn, config, out_dir):
+    """
+    Thickness maps, dose slices and summary rows of every detector of fn.
+    Arrays are saved as .npy in out_dir; returns the written files, the
+    summary rows and the RenderJobs of the plots (rendered by the caller).
+    """
+    from fluka_plots import dose_job, map_job
+
+    stem = os.path.basename(fn).split('.bnn')[0]
+    outputs = []
+    rows = []
+    jobs = []
+    usrbins = get_usrbins(fn, mapped=True)
+    detectors = config['detectors']
+    if detectors is None:
+        detectors = range(len(usrbins))
+    for i in detectors:
+        usrbin = usrbins[i]
+        if config['symmetry']:
+            usrbin = usrbin.folded(*config['symmetry'])
+        data = np.asarray(usrbin.data) * config['norm']
+        g = usrbin.grid
+        prefix = os.path.join(out_dir, '%s_%s' % (stem, i))
+        for axis, index in config['slices']:
+            name = '%s_dose_%s%s.npy' % (prefix, 'XYZ'[axis], index)
+            np.save(name, np.take(data, index, axis=axis))
+            outputs.append(name)
+            if config['plots']:
+                jobs.append(dose_job(usrbin, (axis, index), name[:-4] + '.jpg', norm=config['norm']))
+        for wall, (axis, boundary) in sorted(config['walls'].items()):
+            if boundary <= g.lower[axis] or boundary >= g.upper[axis]:
+                say("WARNING: wall %s at %s is outside detector %s of '%s'" % (wall, boundary, i, fn))
+                continue
+            ranges = [None] * 6
+            ranges[2 * axis + 1] = boundary
+            inside = data[g.slices(*ranges)]
+            try:
+                thickness, failed = wall_thickness(data, g.centres[axis], boundary,
+                                                   target_dose=config['target_dose'], axis=axis)
+            except ValueError as e:
+                say("WARNING: wall %s of detector %s of '%s': %s" % (wall, i, fn, e))
+                continue
+            name = '%s_thickness_%s.npy' % (prefix, wall)
+            np.save(name, thickness)
+            outputs.append(name)
+            if config['plots']:
+                p, q = [a for a in range(3) if a != axis]
+                jobs.append(map_job(name[:-4] + '.jpg', thickness, g.centres[q], g.centres[p],
+                                    '%s, cm' % 'XYZ'[q], '%s, cm' % 'XYZ'[p], 'Wall thickness, cm'))
+            finite = thickness[np.isfinite(thickness)]
+            rows.append([os.path.basename(fn), i, usrbin.name, wall, boundary,
+                         float(np.max(inside)),
+                         float(finite.max()) if finite.size else '',
+                         int(np.count_nonzero(failed))])
+    outputs.extend(job.fn for job in jobs)
+    return outputs, rows, jobs
+
+
+def write_summary(fn, manifest):
+    header = ['file', 'detector', 'name', 'wall', 'boundary', 'max_dose_inside', 'max_thickness', 'failed']
+    with open(fn, 'w') as f:
+        f.write(','.join(header) + '\n')
+        for source in sorted(manifest['files']):
+            for row in manifest['files'][source]['rows']:
+                f.write(','.join(str(v) for v in row) + '\n')
+
+
+def run(directory, config, out_dir=None, pattern='*.bnn.lis', force=False, processes=None):
+    """
+    Analyse the new or changed files of directory. The manifest in out_dir
+    keeps the content hash, the outputs and the summary rows of every file;
+    a file whose hash, config and outputs are unchanged is skipped and its
+    rows reused. Returns (analysed, reused) file names.
+    """
+    from fluka_plots import render
+
+    if out_dir is None:
+        out_dir = os.path.join(directory, 'analysis')
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_fn = os.path.join(out_dir, MANIFEST)
+    manifest = {'config': None, 'files': {}}
+    if os.path.exists(manifest_fn):
+        with open(manifest_fn) as f:
+            manifest = json.load(f)
+    chash = config_hash(config)
+    if manifest['config'] != chash:
+        manifest = {'config': chash, 'files': {}}
+
+    files = sorted(glob.glob(os.path.join(directory, pattern)))
+    analysed = []
+    reused = []
+    jobs = []
+    for fn in files:
+        key = os.path.basename(fn)
+        h = file_hash(fn)
+        entry = manifest['files'].get(key)
+        if not force and entry is not None and entry['hash'] == h \
+                and all(os.path.exists(o) for o in entry['outputs']):
+            reused.append(fn)
+            continue
+        outputs, rows, file_jobs = analyse(fn, config, out_dir)
+        jobs.extend(file_jobs)
+        manifest['files'][key] = {'hash': h, 'outputs': outputs, 'rows': rows}
+        analysed.append(fn)
+    # results of files removed from the directory are dropped
+    present = set(os.path.basename(fn) for fn in files)
+    for key in list(manifest['files']):
+        if key not in present:
+            del manifest['files'][key]
+    if jobs:
+        render(jobs, processes=processes)
+    write_summary(os.path.join(out_dir, SUMMARY), manifest)
+    # written last: an interrupted run is redone
+    tmp = manifest_fn + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, manifest_fn)
+    return analysed, reused
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Incremental wall-thickness analysis of a directory of .bnn.lis files.')
+    parser.add_argument('directory')
+    parser.add_argument('--config', help='JSON file overriding DEFAULT_CONFIG')
+    parser.add_argument('--out', help='output directory (default: DIRECTORY/analysis)')
+    parser.add_argument('--pattern', default='*.bnn.lis')
+    parser.add_argument('--force', action='store_true', help='re-analyse every file')
+    parser.add_argument('--processes', type=int, help='plot rendering processes')
+    parser.add_argument('--no-plots', action='store_true')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    if args.no_plots:
+        config['plots'] = False
+    analysed, reused = run(args.directory, config, args.out, args.pattern, args.force, args.processes)
+    say('%s file(s) analysed, %s reused' % (len(analysed), len(reused)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
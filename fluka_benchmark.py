@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from time import time
+import numpy as np
+from fluka_data import ascii2lines, USRBIN, get_usrbins, data_3D_slice, wall_thickness
+
+
+FILES = ["simple_vault_ns_30.bnn.lis",
+         "simple_vault_ns_concr_local_30.bnn.lis"]
+
+# the mesh of the shipped files, scaled along every axis for synthetic files
+BASE_SHAPE = (40, 18, 109)
+
+
+class LoopUSRBIN(USRBIN):
+    # reference implementation: per-token float() and a triple loop fill
+    def get_data(self):
+        data = []
+        while self.float_number_start.search(self.current_line) is None:
+            self.get_next_line()
+        while self.float_number_start.search(self.current_line) is not None:
+            line = self.current_line.split()
+            for s in line:
+                data.append(float(s))
+            self.get_next_line()
+        nx = self.bins[0][2]
+        ny = self.bins[1][2]
+        nz = self.bins[2][2]
+        b = np.zeros((nx, ny, nz))
+        for i in range(0, nx):
+            for j in range(0, ny):
+                for k in range(0, nz):
+                    b[i, j, k] = float(data[i + nx * j + nx * ny * k])
+        return b
+
+
+def best_of(func, repeat):
+    best = None
+    result = None
+    for i in range(repeat):
+        t0 = time()
+        result = func()
+        dt = time() - t0
+        if best is None or dt < best:
+            best = dt
+    return best, result
+
+
+def peak_memory(func):
+    # traced separately, tracemalloc slows the timed runs down
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_get_data(fn, repeat=5):
+    lines = ascii2lines(fn=fn)
+    t_loop, loop = best_of(lambda: LoopUSRBIN(lines), repeat)
+    t_bulk, bulk = best_of(lambda: USRBIN(lines), repeat)
+    assert np.array_equal(loop.data, bulk.data) and np.array_equal(loop.errors, bulk.errors)
+    return t_loop, t_bulk, bulk.data.size + bulk.errors.size
+
+
+def write_synthetic(fn, shape, ndet=1, seed=0):
+    """
+    Write a .bnn.lis file in the FLUKA USRBIN text format with ndet
+    detectors of the given mesh shape and random log-spread doses.
+    """
+    rng = np.random.default_rng(seed)
+    nx, ny, nz = shape
+    n = nx * ny * nz
+    with open(fn, 'w') as f:
+        for det in range(ndet):
+            f.write('1\n')
+            f.write('   Cartesian binning n.   %d  "SYNTH%-4d " , generalized particle n.  240\n' % (det + 1, det + 1))
+            for name, nb, half in (('X', nx, 353.0), ('Y', ny, 182.0), ('Z', nz, 1091.0)):
+                f.write('      %s coordinate: from %11.4E to %11.4E cm, %5d bins (%11.4E cm wide)\n'
+                        % (name, -half, half, nb, 2 * half / nb))
+            f.write('      Data follow in a matrix A(ix,iy,iz), format (1(5x,1p,10(1x,e11.4)))\n\n')
+            f.write('      accurate deposition along the tracks requested\n\n')
+            values = 10.0 ** rng.uniform(-12, -2, n)
+            errors = rng.uniform(0, 100, n)
+            for block, title in ((values, None), (errors, 'Percentage errors')):
+                if title is not None:
+                    f.write('\n      %s follow in a matrix A(ix,iy,iz), format (1(5x,1p,10(1x,e11.4)))\n\n' % title)
+                for i in range(0, n, 10):
+                    f.write('     ' + ''.join(' %11.4E' % v for v in block[i:i + 10]) + '\n')
+
+
+def stage(fn, name, func, values, nbytes, repeat, setup=None):
+    """Best-of-repeat time, throughput and peak memory of func(setup())."""
+    if setup is None:
+        setup = lambda: None
+    best = None
+    for i in range(repeat):
+        arg = setup()
+        t0 = time()
+        func(arg)
+        dt = time() - t0
+        if best is None or dt < best:
+            best = dt
+    arg = setup()
+    peak = peak_memory(lambda: func(arg))
+    return {'file': os.path.basename(fn), 'stage': name, 'seconds': best,
+            'values': int(values), 'bytes': int(nbytes),
+            'values_per_s': values / best if best > 0 else None,
+            'mb_per_s': nbytes / best / 2 ** 20 if best > 0 else None,
+            'peak_mb': peak / 2 ** 20}
+
+
+def bench_file(fn, repeat=5):
+    """Time the parsing, slicing and fitting hot paths on one file."""
+    size = os.path.getsize(fn)
+    lines = ascii2lines(fn=fn)
+    usrbins = get_usrbins(fn)
+    values = sum(u.data.size + u.errors.size for u in usrbins)
+    u = usrbins[0]
+    g = u.grid
+    results = [
+        stage(fn, 'ascii2lines', lambda arg: ascii2lines(fn=fn), values, size, repeat),
+        stage(fn, 'get_bins', lambda arg: USRBIN(lines, header_only=True), 0, 0, repeat),
+        stage(fn, 'get_data', lambda arg: (arg.get_data(), arg.get_data()),
+              u.data.size + u.errors.size, u.data.nbytes + u.errors.nbytes, repeat,
+              setup=lambda: USRBIN(lines, header_only=True)),
+        stage(fn, 'get_usrbins', lambda arg: get_usrbins(fn), values, size, repeat),
+        stage(fn, 'get_usrbins mapped', lambda arg: get_usrbins(fn, mapped=True), values, size, repeat),
+    ]
+    x = g.centres[0]
+    view = data_3D_slice(u, x[len(x) // 4], x[3 * len(x) // 4])
+    results.append(stage(fn, 'data_3D_slice', lambda arg: data_3D_slice(u, x[len(x) // 4], x[3 * len(x) // 4]),
+                         view.size, view.nbytes, repeat))
+    results.append(stage(fn, 'wall_thickness', lambda arg: wall_thickness(u.data, x, np.median(x)),
+                         u.data.size, u.data.nbytes, repeat))
+    return results
+
+
+def compare(results, baseline):
+    # ratio > 1: slower than the baseline
+    old = {}
+    for r in baseline['results']:
+        old[(r['file'], r['stage'])] = r
+    print('%-42s %-20s %10s %10s %7s' % ('file', 'stage', 'base, s', 'now, s', 'ratio'))
+    for r in results:
+        b = old.get((r['file'], r['stage']))
+        if b is None or not b['seconds']:
+            continue
+        print('%-42s %-20s %10.4f %10.4f %6.2fx'
+              % (r['file'], r['stage'], b['seconds'], r['seconds'], r['seconds'] / b['seconds']))
+
+
+def report(results):
+    print('%-42s %-20s %10s %12s %9s %9s' % ('file', 'stage', 'time, s', 'values/s', 'MB/s', 'peak, MB'))
+    for r in results:
+        print('%-42s %-20s %10.4f %12s %9s %9.1f'
+              % (r['file'], r['stage'], r['seconds'],
+                 '%.3e' % r['values_per_s'] if r['values'] and r['values_per_s'] else '-',
+                 '%.1f' % r['mb_per_s'] if r['bytes'] and r['mb_per_s'] else '-',
+                 r['peak_mb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the fluka_data hot paths.')
+    parser.add_argument('files', nargs='*', help='.bnn.lis files (default: the shipped vault files)')
+    parser.add_argument('--scale', type=int, nargs='*', default=[2],
+                        help='also benchmark synthetic files with the shipped mesh scaled along each axis')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--loop', action='store_true', help='compare get_data with the reference loop parser')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    files = args.files or FILES
+    if args.loop:
+        print('%-42s %10s %10s %8s %14s' % ('file', 'loop, s', 'bulk, s', 'speedup', 'bulk values/s'))
+        for fn in files:
+            t_loop, t_bulk, n = bench_get_data(fn, args.repeat)
+            print('%-42s %10.4f %10.4f %7.1fx %14.3e' % (fn, t_loop, t_bulk, t_loop / t_bulk, n / t_bulk))
+
+    results = []
+    for fn in files:
+        results.extend(bench_file(fn, args.repeat))
+    tmp = tempfile.mkdtemp(prefix='fluka_benchmark_')
+    try:
+        for scale in args.scale or []:
+            shape = tuple(n * scale for n in BASE_SHAPE)
+            fn = os.path.join(tmp, 'synthetic_%dx%dx%d.bnn.lis' % shape)
+            write_synthetic(fn, shape)
+            results.extend(bench_file(fn, args.repeat))
+    finally:
+        shutil.rmtree(tmp)
+    report(results)
+
+    run = {'time': time(), 'python': platform.python_version(), 'numpy': np.__version__,
+           'machine': platform.machine(), 'repeat': args.repeat, 'results': results}
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(run, f, indent=1)
+    return run
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
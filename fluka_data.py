@@ -1,8 +1,13 @@
 import os
 import re
+import glob
+import json
+import mmap
+import shutil
+import struct
+import string
+import hashlib
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
 from time import time
 
 
@@ -10,6 +15,92 @@ def say(msg):
     print(msg)
 
 
+class Profiler(object):
+    """
+    Opt-in per-stage instrumentation of the readers, USRBIN and get_usrbins.
+
+    While enabled (with Profiler() as p: ..., or enable()/disable()) every
+    stage appends a record {'stage', 'seconds', 'bytes', 'values',
+    'allocated'} to .records and passes it to callback, if given.
+    'allocated' is the net traced memory of the stage and is only filled in
+    with allocations=True (tracemalloc). Disabled, a stage costs one global
+    lookup.
+    """
+    def __init__(self, callback=None, allocations=False):
+        self.callback = callback
+        self.allocations = allocations
+        self.records = []
+        self.previous = None
+        self.started_tracing = False
+
+    def enable(self):
+        global _profiler
+        self.previous = _profiler
+        _profiler = self
+        if self.allocations:
+            import tracemalloc
+            # tracing already running belongs to the caller
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+        return self
+
+    def disable(self):
+        global _profiler
+        _profiler = self.previous
+        if self.started_tracing:
+            import tracemalloc
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *args):
+        self.disable()
+
+    def start(self):
+        if self.allocations:
+            import tracemalloc
+            return time(), tracemalloc.get_traced_memory()[0]
+        return time(), 0
+
+    def stop(self, stage, token, nbytes=0, values=0):
+        t0, m0 = token
+        record = {'stage': stage, 'seconds': time() - t0, 'bytes': nbytes,
+                  'values': values, 'allocated': None}
+        if self.allocations:
+            import tracemalloc
+            record['allocated'] = tracemalloc.get_traced_memory()[0] - m0
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def report(self):
+        """Totals per stage: calls, seconds, bytes, values and allocated."""
+        stages = {}
+        for r in self.records:
+            s = stages.setdefault(r['stage'], {'calls': 0, 'seconds': 0.0, 'bytes': 0,
+                                               'values': 0, 'allocated': 0})
+            s['calls'] += 1
+            s['seconds'] += r['seconds']
+            s['bytes'] += r['bytes']
+            s['values'] += r['values']
+            if r['allocated'] is not None:
+                s['allocated'] += r['allocated']
+        return stages
+
+    def summary(self):
+        say('%-14s %6s %10s %12s %12s %12s' % ('stage', 'calls', 'time, s', 'bytes', 'values', 'allocated'))
+        for stage, s in self.report().items():
+            say('%-14s %6d %10.4f %12d %12d %12s'
+                % (stage, s['calls'], s['seconds'], s['bytes'], s['values'],
+                   s['allocated'] if self.allocations else '-'))
+
+
+_profiler = None
+
+
 def __tuple2str__( tupl ):
     st = ''
     for i in range(0, len(tupl)):
@@ -18,6 +109,9 @@ def __tuple2str__( tupl ):
 
 
 def ascii2lines(fn, mode='r'):
+    p = _profiler
+    if p is not None:
+        token = p.start()
     try:
         f = open(file=fn, mode=mode)
         try:
@@ -39,6 +133,8 @@ def ascii2lines(fn, mode='r'):
                     # print("line has been changed: ", line)
                 lines.append(line)
         f.close()
+        if p is not None:
+            p.stop('read', token, nbytes=sum(len(line) for line in lines))
         return lines
     except:
         say("ERROR: Cannot open file '%s'" % (fn))
@@ -72,6 +168,615 @@ def ascii2nparray(fn, mode='r',comment='#'):
     return np.array(lines)
 
 
+def lines2values(lines):
+    """Convert a block of whitespace separated numbers to a 1D float array."""
+    return np.fromstring(' '.join(lines), sep=' ')
+
+
+class MappedLines(object):
+    """
+    Read-only sequence of lines over a memory-mapped text file.
+
+    Lines are located on demand with a cursor that moves from the last
+    accessed line, so the file is never split into a list of strings.
+    Numeric matrices are parsed straight from the mapping, chunk by chunk,
+    by read_values().
+    """
+    chunk_size = 1 << 24
+    block_end = re.compile(rb"\n(?![ \t]*-*[\d]+\.[\d]+E)")
+
+    def __init__(self, fn):
+        p = _profiler
+        if p is not None:
+            token = p.start()
+        self.fn = fn
+        self.file = open(fn, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map)
+        self.nlines = self.count_lines(0, self.size)
+        if self.map[self.size - 1:self.size] != b'\n':
+            self.nlines += 1
+        self._index = 0
+        self._offset = 0
+        if p is not None:
+            p.stop('map', token, nbytes=self.size)
+
+    def __len__(self):
+        return self.nlines
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.nlines
+        if not 0 <= i < self.nlines:
+            raise IndexError("line %s out of range in '%s'" % (i, self.fn))
+        start = self.offset(i)
+        end = self.map.find(b'\n', start)
+        if end < 0:
+            end = self.size
+        return self.map[start:end].decode('utf-8', 'replace')
+
+    def count_lines(self, start, stop):
+        n = 0
+        for pos in range(start, stop, self.chunk_size):
+            n += self.map[pos:min(pos + self.chunk_size, stop)].count(b'\n')
+        return n
+
+    def offset(self, i):
+        # byte offset of line i, walking from the cursor
+        while self._index > i:
+            self._offset = self.map.rfind(b'\n', 0, self._offset - 1) + 1
+            self._index -= 1
+        while self._index < i:
+            self._offset = self.map.find(b'\n', self._offset) + 1
+            self._index += 1
+        return self._offset
+
+    def seek(self, i, offset):
+        # move the cursor to line i known to start at byte offset
+        self._index = i
+        self._offset = offset
+
+    def read_values(self, i, count):
+        """
+        Parse the numeric matrix starting at line i into a 1D float array of
+        length count. Returns the array and the index of the first line after
+        the matrix.
+        """
+        start = self.offset(i)
+        match = self.block_end.search(self.map, start)
+        stop = match.start() + 1 if match is not None else self.size
+        data = np.empty(count)
+        n = 0
+        pos = start
+        while pos < stop:
+            end = min(pos + self.chunk_size, stop)
+            if end < stop:
+                end = self.map.find(b'\n', end, stop) + 1 or stop
+            values = np.fromstring(self.map[pos:end], sep=' ')
+            if n + values.size > count:
+                break
+            data[n:n + values.size] = values
+            n += values.size
+            pos = end
+        if pos < stop or n != count:
+            raise ValueError("matrix at line %s of '%s' does not hold %s values"
+                             % (i, self.fn, count))
+        self._index = i + self.count_lines(start, stop)
+        if stop == self.size and self.map[stop - 1:stop] != b'\n':
+            self._index += 1
+        self._offset = stop
+        return data, self._index
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def ascii2mapped(fn):
+    try:
+        return MappedLines(fn)
+    except (OSError, ValueError):
+        say("ERROR: Cannot map file '%s'" % (fn))
+        return None
+
+
+class USRBINGrid(object):
+    """
+    Cartesian USRBIN mesh built from .bins, with bins[i][0..1] taken as the
+    outer bin edges. Holds the edges, centres and widths of every axis and
+    maps coordinates and ranges to indices arithmetically.
+    """
+    eps = 1.0E-9
+
+    def __init__(self, bins):
+        self.lower = np.array([float(b[0]) for b in bins[:3]])
+        self.upper = np.array([float(b[1]) for b in bins[:3]])
+        self.shape = tuple(int(b[2]) for b in bins[:3])
+        self.width = (self.upper - self.lower) / np.array(self.shape)
+        self.edges = [np.linspace(lo, hi, n + 1) for lo, hi, n in zip(self.lower, self.upper, self.shape)]
+        self.centres = [0.5 * (e[1:] + e[:-1]) for e in self.edges]
+        self.widths = [np.diff(e) for e in self.edges]
+
+    def index(self, axis, value):
+        """Index of the bin holding value along axis."""
+        i = int(np.floor((value - self.lower[axis]) / self.width[axis] + self.eps))
+        if value == self.upper[axis]:
+            i = self.shape[axis] - 1
+        if not 0 <= i < self.shape[axis]:
+            raise IndexError("%s is outside [%s, %s] on axis %s"
+                             % (value, self.lower[axis], self.upper[axis], axis))
+        return i
+
+    def point_index(self, x, y, z):
+        return self.index(0, x), self.index(1, y), self.index(2, z)
+
+    def index_slice(self, axis, vmin=None, vmax=None):
+        """Slice of the bins overlapping [vmin, vmax] along axis."""
+        n = self.shape[axis]
+        i0 = 0
+        i1 = n
+        if vmin is not None:
+            i0 = int(np.floor((vmin - self.lower[axis]) / self.width[axis] + self.eps))
+        if vmax is not None:
+            i1 = int(np.ceil((vmax - self.lower[axis]) / self.width[axis] - self.eps))
+        return slice(min(max(i0, 0), n), min(max(i1, 0), n))
+
+    def slices(self, xmin=None, xmax=None, ymin=None, ymax=None, zmin=None, zmax=None):
+        return (self.index_slice(0, xmin, xmax),
+                self.index_slice(1, ymin, ymax),
+                self.index_slice(2, zmin, zmax))
+
+
+class SparseMesh(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    COO storage of a mostly-zero mesh: the ascending flat (C order)
+    indices and the values of the non-zero bins. Indexing with integers
+    and ranges returns the dense sub-block built from the stored bins
+    only; np.asarray(), arithmetic and ufuncs see the dense mesh. sum, max,
+    min and mean over the whole mesh read the stored values; the other
+    ndarray methods provided (transpose/.T, reshape, ravel) return dense
+    arrays, anything else needs np.asarray() first.
+    """
+    def __init__(self, shape, indices, values):
+        self.shape = tuple(int(n) for n in shape)
+        self.indices = indices
+        self.values = values
+
+    @classmethod
+    def from_dense(cls, a, dtype=None):
+        a = np.asarray(a)
+        indices = np.flatnonzero(a)
+        if a.size < 2 ** 31:
+            indices = indices.astype(np.int32)
+        values = a.ravel()[indices].astype(dtype or a.dtype)
+        return cls(a.shape, indices, values)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nnz(self):
+        return self.values.size
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.values.nbytes
+
+    def toarray(self, dtype=None):
+        a = np.zeros(self.size, dtype=dtype or self.dtype)
+        a[self.indices] = self.values
+        return a.reshape(self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.toarray(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [x.toarray() if isinstance(x, SparseMesh) else x for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        # an integer index is a length-1 range whose axis is dropped
+        ranges = []
+        dropped = []
+        for axis, k in enumerate(key[:self.ndim]):
+            if isinstance(k, (int, np.integer)) and not isinstance(k, (bool, np.bool_)):
+                n = self.shape[axis]
+                if not -n <= k < n:
+                    raise IndexError("index %s is out of bounds for axis %s with size %s" % (k, axis, n))
+                k = slice(k % n, k % n + 1)
+                dropped.append(axis)
+            ranges.append(k)
+        if len(key) > self.ndim or not all(isinstance(k, slice) and k.step in (None, 1) for k in ranges):
+            return self.toarray()[key]
+        ranges += [slice(None)] * (self.ndim - len(ranges))
+        ranges = [k.indices(n)[:2] for k, n in zip(ranges, self.shape)]
+        ranges = [(start, max(stop, start)) for start, stop in ranges]
+        out = np.zeros([stop - start for start, stop in ranges], dtype=self.dtype)
+        # the bins of the first range are one run of the sorted indices
+        stride = int(np.prod(self.shape[1:]))
+        lo, hi = np.searchsorted(self.indices, [ranges[0][0] * stride, ranges[0][1] * stride])
+        indices = self.indices[lo:hi]
+        coords = np.unravel_index(indices, self.shape)
+        inside = np.ones(indices.size, dtype=bool)
+        for c, (start, stop) in zip(coords[1:], ranges[1:]):
+            inside &= (c >= start) & (c < stop)
+        out[tuple(c[inside] - start for c, (start, stop) in zip(coords, ranges))] = self.values[lo:hi][inside]
+        return out.squeeze(axis=tuple(dropped)) if dropped else out
+
+    def astype(self, dtype, copy=True):
+        if not copy and np.dtype(dtype) == self.dtype:
+            return self
+        return SparseMesh(self.shape, self.indices, self.values.astype(dtype))
+
+    def sum(self, axis=None, dtype=None, out=None, keepdims=False):
+        if axis is None and out is None and not keepdims:
+            return self.values.sum(dtype=dtype or np.float64)
+        return self.toarray().sum(axis=axis, dtype=dtype, out=out, keepdims=keepdims)
+
+    def max(self, axis=None, out=None, keepdims=False):
+        if axis is None and out is None and not keepdims:
+            return self._extreme(np.max)
+        return self.toarray().max(axis=axis, out=out, keepdims=keepdims)
+
+    def min(self, axis=None, out=None, keepdims=False):
+        if axis is None and out is None and not keepdims:
+            return self._extreme(np.min)
+        return self.toarray().min(axis=axis, out=out, keepdims=keepdims)
+
+    def _extreme(self, func):
+        # the zero bins count too unless every bin is stored
+        values = self.values
+        if self.nnz < self.size:
+            values = np.append(values, np.zeros(1, dtype=self.dtype))
+        return func(values)
+
+    def mean(self, axis=None, dtype=None, out=None, keepdims=False):
+        if axis is None and out is None and not keepdims:
+            return self.sum(dtype=dtype) / self.size
+        return self.toarray().mean(axis=axis, dtype=dtype, out=out, keepdims=keepdims)
+
+    def transpose(self, *axes):
+        return self.toarray().transpose(*axes)
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def reshape(self, *shape, **kwargs):
+        return self.toarray().reshape(*shape, **kwargs)
+
+    def ravel(self):
+        return self.toarray().ravel()
+
+    def copy(self):
+        return SparseMesh(self.shape, self.indices.copy(), self.values.copy())
+
+
+# storage of .data and .errors: dtype and whether the mesh is kept sparse,
+# None for 'auto' which picks the smaller of float32 and sparse32
+STORAGE_MODES = {'float64': (np.float64, False), 'float32': (np.float32, False),
+                 'sparse': (np.float64, True), 'sparse32': (np.float32, True),
+                 'auto': (np.float32, None)}
+
+
+def compact_array(a, storage):
+    """a converted to a STORAGE_MODES storage ('float32', 'sparse', ...)."""
+    if storage not in STORAGE_MODES:
+        raise ValueError("storage must be one of %s, not %r" % (sorted(STORAGE_MODES), storage))
+    dtype, sparse = STORAGE_MODES[storage]
+    a = np.asarray(a)
+    if sparse is None:
+        # a sparse bin costs its value and an int32 index
+        sparse = 2 * np.count_nonzero(a) < a.size
+    if sparse:
+        return SparseMesh.from_dense(a, dtype=dtype)
+    return a.astype(dtype, copy=False)
+
+
+def fold_mirror(data, errors, axis, mode='sum', block=2 ** 12):
+    """
+    Fold data and percentage errors on the mirror plane through the centre
+    of axis, keeping the upper half; the errors of the two halves combine
+    as independent, the central bin of an odd axis is fully correlated with
+    itself. The halves are read in blocks of about block bins along another
+    axis and cast to float64 there (squared float32 errors of tiny doses
+    underflow), so only the two half-size results, in the dtype of data,
+    are allocated.
+    """
+    n = data.shape[axis]
+    h = n // 2
+    shape = list(data.shape)
+    shape[axis] = n - h
+    folded = np.empty(shape, dtype=data.dtype)
+    out = np.empty(shape, dtype=data.dtype)
+    other = 1 if axis == 0 and data.ndim > 1 else 0
+    step = data.shape[other] if other == axis else max(1, block * shape[other] // max(folded.size, 1))
+    for start in range(0, data.shape[other], step):
+        upper = [slice(None)] * data.ndim
+        upper[other] = slice(start, start + step)
+        lower = list(upper)
+        upper[axis] = slice(h, n)
+        lower[axis] = slice(0, n - h)
+        part = list(upper)
+        part[axis] = slice(None)
+        upper, lower, part = tuple(upper), tuple(lower), tuple(part)
+        d_up = np.asarray(data[upper], dtype=np.float64)
+        d_lo = np.flip(np.asarray(data[lower], dtype=np.float64), axis)
+        # (100 * sigma) ** 2 of both halves, sigma = data * errors / 100
+        var = d_up * errors[upper]
+        var *= var
+        lo = d_lo * np.flip(errors[lower], axis)
+        lo *= lo
+        var += lo
+        if n % 2:
+            centre = [slice(None)] * data.ndim
+            centre[axis] = slice(0, 1)
+            var[tuple(centre)] *= 2.0
+        np.sqrt(var, out=var)
+        # d_up may be a view of data
+        d_up = d_up + d_lo
+        # percent errors, the same for the sum and the mean
+        lo[...] = 0.0
+        np.divide(var, np.abs(d_up), out=lo, where=d_up != 0)
+        if mode == 'mean':
+            d_up /= 2.0
+        folded[part] = d_up
+        out[part] = lo
+    return folded, out
+
+
+def _edge_points(va, vb, pa, pb, threshold):
+    # linear interpolation of the threshold crossing between two samples
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = ((threshold - va) / (vb - va))[..., None]
+        return pa + w * (pb - pa)
+
+
+def contour_segments(values, u, v, threshold):
+    """
+    Marching squares on a 2D array sampled at u (rows) and v (columns).
+    Returns the contour at threshold as an (M, 2, 2) array of segments
+    with (u, v) end points. Saddles are resolved with the cell mean.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    uu, vv = np.meshgrid(u, v, indexing='ij')
+    pts = np.stack([uu, vv], axis=-1)
+    # corners of every cell, counter-clockwise
+    corners = [(slice(0, -1), slice(0, -1)), (slice(1, None), slice(0, -1)),
+               (slice(1, None), slice(1, None)), (slice(0, -1), slice(1, None))]
+    c = [values[s] for s in corners]
+    p = [pts[s] for s in corners]
+    above = [ci >= threshold for ci in c]
+    cross = [above[k] != above[(k + 1) % 4] for k in range(4)]
+    edge = [_edge_points(c[k], c[(k + 1) % 4], p[k], p[(k + 1) % 4], threshold)
+            for k in range(4)]
+    ncross = sum(x.astype(int) for x in cross)
+    segments = []
+    for k1 in range(4):
+        for k2 in range(k1 + 1, 4):
+            sel = (ncross == 2) & cross[k1] & cross[k2]
+            segments.append(np.stack([edge[k1][sel], edge[k2][sel]], axis=1))
+    saddle = ncross == 4
+    if np.any(saddle):
+        joined = (sum(c) / 4.0 >= threshold) == above[0]
+        # corner 0 connected to corner 2 through the centre: cut off corners 1 and 3
+        for sel, pairs in ((saddle & joined, ((0, 1), (2, 3))),
+                           (saddle & ~joined, ((3, 0), (1, 2)))):
+            for k1, k2 in pairs:
+                segments.append(np.stack([edge[k1][sel], edge[k2][sel]], axis=1))
+    return np.concatenate(segments, axis=0)
+
+
+def _tetra_table():
+    # marching tetrahedra: triangles, as vertex pairs, for every inside mask
+    table = {}
+    for code in range(1, 15):
+        inside = [k for k in range(4) if code >> k & 1]
+        outside = [k for k in range(4) if not code >> k & 1]
+        if len(inside) == 2:
+            a, b = inside
+            c, d = outside
+            table[code] = [[(a, c), (a, d), (b, d)], [(a, c), (b, d), (b, c)]]
+        else:
+            lone = inside[0] if len(inside) == 1 else outside[0]
+            others = [k for k in range(4) if k != lone]
+            table[code] = [[(lone, k) for k in others]]
+    return table
+
+
+TETRA_TABLE = _tetra_table()
+# cube corner k sits at (k & 1, k >> 1 & 1, k >> 2 & 1); six tetrahedra around the 0-7 diagonal
+CUBE_TETRAHEDRA = ((0, 1, 3, 7), (0, 1, 5, 7), (0, 2, 3, 7), (0, 2, 6, 7), (0, 4, 5, 7), (0, 4, 6, 7))
+
+
+def isosurface_triangles(values, centres, threshold):
+    """
+    Marching tetrahedra on a 3D array sampled at centres (x, y, z arrays).
+    Returns the iso-surface at threshold as a (T, 3, 3) array of triangles.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    pts = np.stack(np.meshgrid(*centres, indexing='ij'), axis=-1)
+    c = []
+    p = []
+    for k in range(8):
+        s = tuple(slice(1, None) if k >> a & 1 else slice(0, -1) for a in range(3))
+        c.append(values[s].ravel())
+        p.append(pts[s].reshape(-1, 3))
+    triangles = []
+    for tet in CUBE_TETRAHEDRA:
+        tv = [c[k] for k in tet]
+        tp = [p[k] for k in tet]
+        code = sum((tv[k] >= threshold).astype(int) << k for k in range(4))
+        for key, tris in TETRA_TABLE.items():
+            sel = code == key
+            if not np.any(sel):
+                continue
+            for tri in tris:
+                triangles.append(np.stack([_edge_points(tv[a][sel], tv[b][sel], tp[a][sel], tp[b][sel], threshold)
+                                           for a, b in tri], axis=1))
+    if not triangles:
+        return np.zeros((0, 3, 3))
+    return np.concatenate(triangles, axis=0)
+
+
+class USRBINBase(object):
+    """Helpers shared by every USRBIN detector class (needs .bins, .data, .errors)."""
+
+    @property
+    def grid(self):
+        if getattr(self, '_grid', None) is None:
+            self._grid = USRBINGrid(self.bins)
+        return self._grid
+
+    def sub_volume(self, xmin=None, xmax=None, ymin=None, ymax=None, zmin=None, zmax=None):
+        """
+        Views (no copy) of .data and .errors over the bins overlapping the
+        ranges; dense copies of the block for SparseMesh storage.
+        """
+        s = self.grid.slices(xmin, xmax, ymin, ymax, zmin, zmax)
+        return self.data[s], self.errors[s]
+
+    def compact(self, storage):
+        """
+        Convert .data and .errors to a storage mode: 'float64', 'float32'
+        (half the memory, FLUKA prints 5 significant digits), 'sparse' /
+        'sparse32' (SparseMesh of the non-zero bins) or 'auto' (float32 or
+        sparse32, whichever is smaller for each matrix).
+        """
+        self.data = compact_array(self.data, storage)
+        self.errors = compact_array(self.errors, storage)
+        return self
+
+    def interpolate(self, points, mode='linear', outside=np.nan):
+        """
+        Dose and percentage error at an (N, 3) array of points.
+
+        mode='nearest' takes the bin holding each point, mode='linear'
+        interpolates trilinearly between bin centres (held constant between
+        the outer centres and the mesh edges) and propagates the bin errors
+        as independent. Points outside the mesh get outside.
+        """
+        if mode not in ('nearest', 'linear'):
+            raise ValueError("mode must be 'nearest' or 'linear', not %r" % mode)
+        g = self.grid
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        t = (points - g.lower) / g.width
+        inside = np.all((points >= g.lower) & (points <= g.upper), axis=1)
+        shape = np.array(g.shape)
+        data = np.asarray(self.data)
+        errors = np.asarray(self.errors)
+        if mode == 'nearest':
+            i = np.clip(np.floor(t).astype(np.intp), 0, shape - 1)
+            dose = data[i[:, 0], i[:, 1], i[:, 2]].astype(np.float64)
+            err = errors[i[:, 0], i[:, 1], i[:, 2]].astype(np.float64)
+        else:
+            t = t - 0.5
+            i0 = np.clip(np.floor(t).astype(np.intp), 0, np.maximum(shape - 2, 0))
+            i1 = np.minimum(i0 + 1, shape - 1)
+            w1 = np.clip(t - i0, 0.0, 1.0)
+            w0 = 1.0 - w1
+            sigma = data * errors / 100.0
+            dose = np.zeros(len(points))
+            var = np.zeros(len(points))
+            for cx in (0, 1):
+                for cy in (0, 1):
+                    for cz in (0, 1):
+                        ix = (i0, i1)[cx][:, 0]
+                        iy = (i0, i1)[cy][:, 1]
+                        iz = (i0, i1)[cz][:, 2]
+                        w = (w0, w1)[cx][:, 0] * (w0, w1)[cy][:, 1] * (w0, w1)[cz][:, 2]
+                        dose += w * data[ix, iy, iz]
+                        var += (w * sigma[ix, iy, iz]) ** 2
+            err = np.zeros(len(points))
+            np.divide(100.0 * np.sqrt(var), np.abs(dose), out=err, where=dose != 0)
+        dose[~inside] = outside
+        err[~inside] = outside
+        return dose, err
+
+    def isodose_lines(self, plane, thresholds, norm=1.0):
+        """
+        Isodose contours of the plane (axis, index), e.g. (1, 4) for
+        data[:, 4, :], scaled by norm. Returns {threshold: (M, 2, 2) array}
+        of segments, points given as (p, q) coordinates of the two in-plane
+        axes p < q at the bin centres.
+        """
+        axis, index = plane
+        p, q = [a for a in range(3) if a != axis]
+        values = np.take(np.asarray(self.data), index, axis=axis) * norm
+        g = self.grid
+        return dict((float(t), contour_segments(values, g.centres[p], g.centres[q], t))
+                    for t in np.atleast_1d(thresholds))
+
+    def isodose_surfaces(self, thresholds, norm=1.0):
+        """
+        Iso-surfaces of the whole volume scaled by norm, between bin
+        centres. Returns {threshold: (T, 3, 3) array} of triangles in x, y, z.
+        """
+        values = np.asarray(self.data) * norm
+        return dict((float(t), isosurface_triangles(values, self.grid.centres, t))
+                    for t in np.atleast_1d(thresholds))
+
+    def set_symmetry(self, axes, mode='sum'):
+        """
+        Declare mirror planes through the mesh centre along axes (0=x, 1=y,
+        2=z). mode='sum' adds the mirrored halves, like data + np.flip(data,
+        axis) for a mirrored source, mode='mean' averages them for a
+        symmetric model. Used as the default by folded() and fold().
+        """
+        if mode not in ('sum', 'mean'):
+            raise ValueError("mode must be 'sum' or 'mean', not %r" % mode)
+        self.symmetry = (tuple(np.atleast_1d(axes)), mode)
+
+    def folded(self, axes=None, mode=None):
+        """
+        Half-volume USRBINData folded on the mirror planes, with the errors
+        of the two halves combined as independent (the central bin of an odd
+        axis is its own mirror), in the dtype of .data. Nothing mesh-sized
+        is allocated, see fold_mirror.
+        """
+        sym_axes, sym_mode = getattr(self, 'symmetry', ((), 'sum'))
+        axes = sym_axes if axes is None else tuple(np.atleast_1d(axes))
+        mode = sym_mode if mode is None else mode
+        bins = [list(b) for b in self.bins]
+        data = self.data
+        errors = self.errors
+        dtype = data.dtype
+        for axis in axes:
+            data, errors = fold_mirror(data, errors, axis, mode)
+            n = int(bins[axis][2])
+            bins[axis][0] = float(self.grid.edges[axis][n // 2])
+            bins[axis][2] = n - n // 2
+        data = np.asarray(data, dtype=dtype)
+        errors = np.asarray(errors, dtype=dtype)
+        return USRBINData(bins, data, errors, name=getattr(self, 'name', None),
+                          particle=getattr(self, 'particle', None))
+
+    def fold(self, axes=None, mode=None):
+        """Replace .bins, .data and .errors by the folded half-volume."""
+        half = self.folded(axes, mode)
+        if isinstance(self.data, SparseMesh):
+            half.data = SparseMesh.from_dense(half.data)
+            half.errors = SparseMesh.from_dense(half.errors)
+        self.bins = half.bins
+        self.data = half.data
+        self.errors = half.errors
+        self._grid = None
+
+
 class DataNode(object):
     def __init__(self, lines, nstart=0):
         self.current_line_number = nstart
@@ -83,6 +788,8 @@ class DataNode(object):
         any_number_pattern = "(-*)([\d]+)(\.*)([\d]*)(E*)([+]*)([-]*)([\d]*)"
         any_number_start_pattern = "^(-*)([\d]+)(\.*)([\d]*)(E*)([+]*)([-]*)([\d]*)"
         from_line_pattern = "from *-*[\d]"
+        binning_line_pattern = 'binning n\\. *([\\d]+) *"([^"]*)" *, *(generalized )?particle n\\. *(-*[\\d]+)'
+        self.binning_line = re.compile(binning_line_pattern)
         self.from_line = re.compile(from_line_pattern)
         self.float_number = re.compile(float_number_pattern)
         self.float_number_start = re.compile(float_number_start_pattern)
@@ -91,8 +798,7 @@ class DataNode(object):
 
     def skip_empty_lines(self):
         while self.current_line == '':
-            self.current_line_number += 1
-            self.current_line = self.lines[self.current_line_number].strip()
+            self.get_next_line()
 
     def peek_next_line(self):
         i = self.current_line_number + 1
@@ -106,24 +812,37 @@ class DataNode(object):
         if i < self.nmax:
             self.current_line_number = i
             self.current_line = self.lines[self.current_line_number].strip()
+        elif i > self.nmax:
+            # a header or matrix searched past the end: truncated file
+            raise ValueError("unexpected end of file after %s lines" % self.nmax)
         else:
             self.current_line_number = i
             self.current_line = 'EOF'
 
 
-class USRBIN(DataNode):
-    def __init__(self, lines, nstart=0):
+class USRBIN(DataNode, USRBINBase):
+    def __init__(self, lines, nstart=0, header_only=False):
         super(USRBIN, self).__init__(lines, nstart=nstart)
         self.tag_data_begin = '1'
+        self.name = None
+        self.particle = None
         self.bins = self.get_bins()
-        self.data = self.get_data()
-        self.errors = self.get_data()
+        if not header_only:
+            self.data = self.get_data()
+            self.errors = self.get_data()
 
     def get_bins(self):
+        p = _profiler
+        if p is not None:
+            token = p.start()
         bins = []
         while self.current_line != self.tag_data_begin:
             self.get_next_line()
         while self.from_line.search(self.current_line) is None:
+            binning = self.binning_line.search(self.current_line)
+            if binning is not None:
+                self.name = binning.group(2).strip()
+                self.particle = int(binning.group(4))
             self.get_next_line()
         while self.from_line.search(self.current_line) is not None:
             coord = self.any_number.findall(self.current_line)
@@ -134,426 +853,922 @@ class USRBIN(DataNode):
             self.get_next_line()
         for i in range(len(bins)):
             bins[i][2] = int(bins[i][2])
+        if p is not None:
+            p.stop('get_bins', token)
         return bins
 
     def get_data(self):
-        data = []
+        # bulk parse: the whole block is converted by numpy in one call
+        # and reshaped in Fortran order, A(ix,iy,iz)
+        p = _profiler
+        if p is not None:
+            token = p.start()
         while self.float_number_start.search(self.current_line) is None:
             self.get_next_line()
-        while self.float_number_start.search(self.current_line) is not None:
-            line = self.current_line.split()
-            for s in line:
-                data.append(float(s))
-            self.get_next_line()
         nx = self.bins[0][2]
         ny = self.bins[1][2]
         nz = self.bins[2][2]
-        b = np.zeros((nx, ny, nz))
-        for i in range(0, nx):
-            for j in range(0, ny):
-                for k in range(0, nz):
-                    b[i, j, k] = float(data[i + nx * j + nx * ny * k])
-        return b
-
+        if isinstance(self.lines, MappedLines):
+            # streamed from the mapping, no line strings are built
+            if p is not None:
+                p.stop('scan', token)
+                token = p.start()
+                offset = self.lines.offset(self.current_line_number)
+            data, nstop = self.lines.read_values(self.current_line_number, nx * ny * nz)
+            if p is not None:
+                p.stop('convert', token, nbytes=self.lines.offset(nstop - 1) - offset, values=data.size)
+                token = p.start()
+            self.current_line_number = nstop - 1
+            self.get_next_line()
+        else:
+            nstart = self.current_line_number
+            while self.float_number_start.search(self.current_line) is not None:
+                self.get_next_line()
+            block = self.lines[nstart:self.current_line_number]
+            if p is not None:
+                p.stop('scan', token)
+                token = p.start()
+            data = lines2values(block)
+            if p is not None:
+                p.stop('convert', token, nbytes=sum(len(line) for line in block), values=data.size)
+                token = p.start()
+        if data.size != nx * ny * nz:
+            raise ValueError("USRBIN block has %s values, expected %s x %s x %s"
+                             % (data.size, nx, ny, nz))
+        data = data.reshape((nx, ny, nz), order='F')
+        if p is not None:
+            p.stop('fill', token, values=data.size)
+        return data
 
 
 #
 #
 
-def get_usrbins(fn):
-    lines = ascii2lines(fn=fn)
-    start = 0
-    data = []
-    usrbin = USRBIN(lines, nstart=start)
-    data.append(usrbin)
-    while usrbin.current_line is not 'EOF':
-        usrbin = USRBIN(lines, nstart=usrbin.current_line_number)
+class LazyUSRBIN(USRBINBase):
+    """
+    Detector found by USRBINIndex. Name, particle and bins come from the
+    header scan; .data and .errors are parsed on first access.
+    """
+    def __init__(self, lines, line, offset, end, header, storage=None):
+        self.lines = lines
+        self.line = line
+        self.offset = offset
+        self.end = end
+        self.name = header.name
+        self.particle = header.particle
+        self.bins = header.bins
+        self.storage = storage
+        self.usrbin = None
+
+    def load(self):
+        if self.usrbin is None:
+            self.lines.seek(self.line, self.offset)
+            self.usrbin = USRBIN(self.lines, nstart=self.line)
+            if self.storage is not None:
+                self.usrbin.compact(self.storage)
+        return self.usrbin
+
+    @property
+    def data(self):
+        return self.load().data
+
+    @data.setter
+    def data(self, value):
+        self.load().data = value
+
+    @property
+    def errors(self):
+        return self.load().errors
+
+    @errors.setter
+    def errors(self, value):
+        self.load().errors = value
+
+
+class USRBINIndex(object):
+    """
+    Lazy list of the USRBIN detectors in a .bnn.lis file.
+
+    Opening the file memory-maps it and locates every detector header with
+    byte searches, recording its line, byte range and binning; no matrix is
+    parsed until a detector's .data or .errors is used, then kept in the
+    given storage mode (see USRBINBase.compact).
+    """
+    header_tag = b' binning n.'
+
+    def __init__(self, fn, storage=None):
+        self.fn = fn
+        self.lines = MappedLines(fn)
+        self.detectors = []
+        mm = self.lines.map
+        line = 0
+        offset = 0
+        pos = mm.find(self.header_tag)
+        while pos >= 0:
+            # a detector starts at the '1' line just before its header
+            start = mm.rfind(b'\n1', 0, pos) + 1
+            line += self.lines.count_lines(offset, start)
+            offset = start
+            self.lines.seek(line, offset)
+            header = USRBIN(self.lines, nstart=line, header_only=True)
+            if self.detectors:
+                self.detectors[-1].end = start
+            self.detectors.append(LazyUSRBIN(self.lines, line, offset, self.lines.size, header, storage))
+            pos = mm.find(self.header_tag, self.lines.offset(header.current_line_number))
+
+    def __len__(self):
+        return len(self.detectors)
+
+    def __getitem__(self, i):
+        return self.detectors[i]
+
+    def __iter__(self):
+        return iter(self.detectors)
+
+    def close(self):
+        self.lines.close()
+
+
+def compact_usrbins(usrbins, storage):
+    if storage is not None:
+        for usrbin in usrbins:
+            usrbin.compact(storage)
+    return usrbins
+
+
+def get_usrbins(fn, mapped=False, cache=None, lazy=False, storage=None):
+    """
+    Read all USRBIN detectors of a .bnn.lis file. With mapped=True the file
+    is memory-mapped and streamed instead of being read into a list of lines.
+    With lazy=True a USRBINIndex is returned and each detector is parsed only
+    when its data is first used.
+    FLUKA unformatted binary files are detected and read natively, a
+    single-group HDF5 archive is opened as a USRBINArchive.
+    A USRBINCache passed as cache is checked before parsing.
+    storage ('float32', 'sparse', ...) converts every detector as soon as
+    it is read, see USRBINBase.compact.
+    """
+    if cache is not None:
+        return compact_usrbins(cache.get_usrbins(fn, mapped=mapped), storage)
+    if is_fortran_binary(fn):
+        return compact_usrbins(get_usrbins_binary(fn), storage)
+    if is_hdf5(fn):
+        return USRBINArchive(fn)
+    if lazy:
+        return USRBINIndex(fn, storage=storage)
+    p = _profiler
+    if p is not None:
+        token = p.start()
+    if mapped:
+        lines = ascii2mapped(fn)
+    else:
+        lines = ascii2lines(fn=fn)
+    if lines is None:
+        raise IOError("Cannot read '%s'" % fn)
+    try:
+        if len(lines) == 0:
+            raise ValueError("'%s' is empty" % fn)
+        start = 0
+        data = []
+        usrbin = USRBIN(lines, nstart=start)
         data.append(usrbin)
+        # blank lines after the last matrix are not another detector
+        usrbin.skip_empty_lines()
+        while usrbin.current_line != 'EOF':
+            usrbin = USRBIN(lines, nstart=usrbin.current_line_number)
+            data.append(usrbin)
+            # the float64 matrices of the previous detector can go now
+            compact_usrbins(data[-2:-1], storage)
+            usrbin.skip_empty_lines()
+        compact_usrbins(data[-1:], storage)
+    finally:
+        if mapped:
+            lines.close()
+    if p is not None:
+        p.stop('get_usrbins', token, nbytes=os.path.getsize(fn),
+               values=sum(u.data.size + u.errors.size for u in data))
     #print(len(data))
     return data
 
 
-def data_3D_slice(usrbin_data,
-            xmin=None, xmax=None,
-            ymin=None, ymax=None,
-            zmin=None, zmax=None):
-    bins = usrbin_data.bins
-    x = np.linspace(bins[0][0], bins[0][1], bins[0][2])
-    y = np.linspace(bins[1][0], bins[1][1], bins[1][2])
-    z = np.linspace(bins[2][0], bins[2][1], bins[2][2])
-    # X
-    if xmin is not None:
-        ix_min = np.where(x >= xmin)[0]
-    else:
-        ix_min = 0
-    if xmax is not None:
-        ix_max = np.where(x <= xmax)[-1]
-    else:
-        ix_max = bins[0][2]
-    # Y
-    if ymin is not None:
-        iy_min = np.where(y >= ymin)[0][0]
-    else:
-        iy_min = 0
-    if ymax is not None:
-        iy_max = np.where(y <= ymax)[0][-1]
-    else:
-        iy_max = bins[1][2]
-    # Z
-    if zmin is not None:
-        iz_min = np.where(z >= zmin)[0]
-    else:
-        iz_min = 0
-    if zmax is not None:
-        iz_max = np.where(z <= zmax)[-1]
-    else:
-        iz_max = bins[2][2]
-    print(ix_min,ix_max, iy_min,iy_max, iz_min,iz_max)
-    return usrbin.data[ix_min:ix_max, iy_min:iy_max, iz_min:iz_max]
-
-
-def data_2D_plot(data, x1, x2 ,proj):
-    pass
-
-
-#path = "/home/apatapenka/NorthStar/fluka_simulations/Layout_radiation_protection/NorthStar_design_vault/30kev_treshold/"
-#fn = "simple_vault_ns_concr_local_40.bnn.lis"
-fn = "simple_vault_ns_concr_local_30.bnn.lis"
-#fn = "simple_vault_ns_30.bnn.lis"
-#fn = os.path.join(path, fn)
-
-data_ = get_usrbins(fn)
-bins = data_[0].bins
-x = np.linspace(bins[0][0], bins[0][1], bins[0][2])
-y = np.linspace(bins[1][0], bins[1][1], bins[1][2])
-z = np.linspace(bins[2][0], bins[2][1], bins[2][2])
-#print(bins)
-
-from scipy.optimize import curve_fit
-
-def exp_f(x, a, b):
-    return a * np.exp(b * x)
-
-#x = np.linspace(0,4,50)
-#y = exp_f(x, 2.5, 1.3)
-#yn = y + 0.2*np.random.normal(size=len(x))
-#p0 = [1, 1]
-#popt, pcov = curve_fit(exp_f, x, yn, p0=p0)
-#print(popt, pcov)
-
-##################
-# X = 0; I = 18
-# Y = 0; I = 4
-# walls : X = 203:433  cm
-#         Z = 861:1091 cm
-##################
-
-norm = (1.2E+5/4.0E+7)*6.2415E+18*1.0E-12*3600
-
-data = data_[0].data * norm
-data = data + np.flip(data, 2)
-
-ax = plt.figure()
-plt.imshow(np.log10(np.sum(data,1)))
-
-"""
-##################################################
-#
-# Prompt doses YZ
-#
-##################################################
-
-
-# i_y = 4  # 0-10
-# i_z = 17 # 0-108
-
-W = np.zeros((108, 18))
-W = W + 2.3
-lambda_coeff = []
-for i_y in range(0, 18):
-    for i_z in range(0, 108):
-
-        inds = np.where(x > 203)
-        yd = data[:, i_y, i_z][inds]
-        xd = x[inds]
-        Dose_after_wall = yd[-1]
-        Dose_desired = 5.0E-5
-
-        if Dose_after_wall > Dose_desired:
-
-            a, b = np.polyfit(xd, np.log(yd), 1, w=np.sqrt(yd))
-
-            a,b = np.polyfit(xd, np.log(yd), 1) #, w=np.sqrt(yd))
-            y_a = a*xd + b
-            yd_a = np.exp(a*xd + b)
-
-            # errors :
-            mx = np.average(xd)
-            my = np.average(yd)
-            Dyy = np.sum((np.log(yd) - np.average(np.log(yd)))**2)
-            Dxx = np.sum((xd - np.average(xd))**2)
-            sk = np.sqrt(1/(len(xd)-2) * (Dyy/Dxx - a**2))
-
-
-            inds = np.where( x < 203)
-            Dose_ = data[:, i_y, i_z][inds]
-            Dose_0 = Dose_[-1]
-            #print('Dose inner wall ', Dose_0)
+def fortran_records(fn):
+    """Iterate over the records of a FLUKA (Fortran unformatted) binary file."""
+    with open(fn, 'rb') as f:
+        while True:
+            marker = f.read(4)
+            if len(marker) < 4:
+                return
+            size = struct.unpack('=i', marker)[0]
+            record = f.read(size)
+            end = f.read(4)
+            if len(record) != size or len(end) < 4 or struct.unpack('=i', end)[0] != size:
+                raise IOError("Truncated Fortran record in '%s'" % fn)
+            yield record
+
+
+def is_fortran_binary(fn):
+    # binary scoring files start with the run title record (116-128 bytes)
+    with open(fn, 'rb') as f:
+        marker = f.read(4)
+    return len(marker) == 4 and struct.unpack('=i', marker)[0] in (116, 120, 124, 128)
+
+
+def float32_value(v):
+    # shortest decimal of a float32, e.g. 19.65 rather than 19.649999618530273
+    return float(str(np.float32(v)))
+
+
+def same_binning(bins1, bins2, rtol=1.0e-6):
+    """True if two USRBIN binnings have the same bin numbers and limits."""
+    if len(bins1) != len(bins2):
+        return False
+    for b1, b2 in zip(bins1, bins2):
+        if int(b1[2]) != int(b2[2]) or not np.allclose(b1[:2], b2[:2], rtol=rtol):
+            return False
+    return True
+
+
+class BinaryUSRBIN(USRBINBase):
+    """
+    USRBIN detector read from a FLUKA unformatted binary file (_fort.NN or
+    usbsuw .bnn). Exposes the same .bins, .data and .errors as USRBIN; the
+    errors are in percent as in the "Percentage errors follow" block, and
+    stay zero for raw single-cycle files that carry no statistics.
+    """
+    header_format = '=i10siiffifffifffififff'
+
+    def __init__(self, header, data):
+        header = struct.unpack(self.header_format, header)
+        self.number = header[0]
+        self.name = header[1].decode('ascii', 'replace').strip('\x00 ')
+        self.binning_type = header[2]
+        self.particle = header[3]
+        self.bins = []
+        for i in (4, 8, 12):
+            low, high, n, width = [float32_value(v) for v in header[i:i + 4]]
+            self.bins.append([low, high, int(n), width])
+        nx = self.bins[0][2]
+        ny = self.bins[1][2]
+        nz = self.bins[2][2]
+        self.data = self.record2array(data, nx * ny * nz).reshape((nx, ny, nz), order='F')
+        self.errors = np.zeros((nx, ny, nz))
+
+    def set_errors(self, record):
+        # usbsuw stores relative errors, the .lis listing prints percent
+        errors = self.record2array(record, self.data.size) * 100.0
+        self.errors = errors.reshape(self.data.shape, order='F')
+
+    @staticmethod
+    def record2array(record, count):
+        if len(record) != 4 * count:
+            raise ValueError("USRBIN record has %s bytes, expected %s float32 values"
+                             % (len(record), count))
+        return np.frombuffer(record, dtype='=f4').astype(np.float64)
+
+
+def get_usrbins_binary(fn):
+    """Read all USRBIN detectors of a FLUKA unformatted binary file."""
+    p = _profiler
+    if p is not None:
+        token = p.start()
+    records = fortran_records(fn)
+
+    def next_record():
+        record = next(records, None)
+        if record is None:
+            raise IOError("Unexpected end of '%s'" % fn)
+        return record
+
+    next_record()  # run title, date, weight and number of primaries
+    data = []
+    for record in records:
+        if record[:10] == b'STATISTICS':
+            for usrbin in data:
+                usrbin.set_errors(next_record())
+            break
+        if len(record) != struct.calcsize(BinaryUSRBIN.header_format):
+            raise IOError("Invalid USRBIN header record in '%s'" % fn)
+        data.append(BinaryUSRBIN(record, next_record()))
+    if not data:
+        raise IOError("No USRBIN detector in '%s'" % fn)
+    if p is not None:
+        p.stop('read binary', token, nbytes=os.path.getsize(fn),
+               values=sum(u.data.size + u.errors.size for u in data))
+    return data
 
-            a_min = a + np.abs(1*sk)
-            Thickness = -(np.log(Dose_0) - np.log(Dose_desired))/a_min
 
+def write_usrbins_binary(fn, usrbins, title='', weight=1.0, ncase=1):
+    """
+    Write detectors as a FLUKA unformatted USRBIN file with a STATISTICS
+    section (the layout usbsuw produces), readable by get_usrbins.
+    Errors are expected in percent, as in .errors.
+    """
+    def record(payload):
+        marker = struct.pack('=i', len(payload))
+        return marker + payload + marker
+
+    with open(fn, 'wb') as f:
+        f.write(record(struct.pack('=80s32sfii', title.encode()[:80], b'', weight, ncase, 1)))
+        for i, usrbin in enumerate(usrbins):
+            bins = []
+            for low, high, n, width in usrbin.bins:
+                bins += [low, high, int(n), width]
+            name = getattr(usrbin, 'name', None) or 'USRBIN%s' % (i + 1)
+            f.write(record(struct.pack(BinaryUSRBIN.header_format, i + 1, name.encode()[:10],
+                                       getattr(usrbin, 'binning_type', 0),
+                                       getattr(usrbin, 'particle', None) or 0,
+                                       *(bins + [0, 0.0, 0.0, 0.0]))))
+            f.write(record(np.asarray(usrbin.data, dtype='=f4').tobytes(order='F')))
+        f.write(record(b'STATISTICS' + struct.pack('=i', len(usrbins))))
+        for usrbin in usrbins:
+            errors = np.asarray(usrbin.errors, dtype=np.float64) / 100.0
+            f.write(record(errors.astype('=f4').tobytes(order='F')))
+
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+
+def is_hdf5(fn):
+    with open(fn, 'rb') as f:
+        return f.read(8) == HDF5_SIGNATURE
+
+
+def write_usrbins_hdf5(fn, usrbins, group=None, source=None, chunks=16,
+                       compression='gzip', compression_opts=4):
+    """
+    Store detectors in the HDF5 archive fn (created or appended to) under
+    group, replacing it; group defaults to the base name of source. Every
+    detector is a subgroup with chunked, compressed 'data' and 'errors'
+    datasets (chunks of at most chunks bins per axis, so a plane or
+    sub-volume read touches only the chunks it crosses) and bins, name and
+    particle as attributes. Matrices keep their dtype (see compact).
+    """
+    import h5py
+    if group is None:
+        if source is None:
+            raise ValueError("write_usrbins_hdf5 needs a group or a source file name")
+        group = os.path.basename(source)
+    with h5py.File(fn, 'a') as f:
+        if group in f:
+            del f[group]
+        g = f.create_group(group)
+        if source is not None:
+            g.attrs['source'] = os.path.abspath(source)
+        for i, usrbin in enumerate(usrbins):
+            det = g.create_group('det_%s' % i)
+            det.attrs['bins'] = np.array(usrbin.bins, dtype=np.float64)
+            det.attrs['name'] = getattr(usrbin, 'name', None) or ''
+            det.attrs['particle'] = getattr(usrbin, 'particle', None) or 0
+            for key in ('data', 'errors'):
+                a = np.asarray(getattr(usrbin, key))
+                det.create_dataset(key, data=a, chunks=tuple(min(n, chunks) for n in a.shape),
+                                   compression=compression, compression_opts=compression_opts,
+                                   shuffle=True)
+
+
+class HDF5USRBIN(USRBINBase):
+    """
+    Detector of a USRBINArchive. .data and .errors are the h5py datasets:
+    indexing them (data[:, 4, :], data_3D_slice, sub_volume) reads only the
+    requested hyperslab, np.asarray() reads the whole matrix.
+    """
+    def __init__(self, det):
+        self.bins = [[b[0], b[1], int(b[2]), b[3]] for b in det.attrs['bins'].tolist()]
+        self.name = det.attrs['name'] or None
+        self.particle = int(det.attrs['particle'])
+        self.data = det['data']
+        self.errors = det['errors']
+
+    def read(self, xmin=None, xmax=None, ymin=None, ymax=None, zmin=None, zmax=None):
+        """USRBINData of the bins overlapping the ranges, read from the archive."""
+        s = self.grid.slices(xmin, xmax, ymin, ymax, zmin, zmax)
+        bins = [[float(e[k.start]), float(e[k.stop]), k.stop - k.start, float(w)]
+                for e, k, w in zip(self.grid.edges, s, self.grid.width)]
+        return USRBINData(bins, self.data[s], self.errors[s], name=self.name, particle=self.particle)
+
+
+class USRBINArchive(object):
+    """
+    Read-only list of the detectors stored under one group of an HDF5
+    archive written by write_usrbins_hdf5. group may be omitted when the
+    archive holds a single group; groups() lists them.
+    """
+    def __init__(self, fn, group=None):
+        import h5py
+        self.fn = fn
+        self.file = h5py.File(fn, 'r')
+        if group is None:
+            groups = self.groups()
+            if len(groups) != 1:
+                self.file.close()
+                raise ValueError("'%s' holds %s groups, choose one of %s" % (fn, len(groups), groups))
+            group = groups[0]
+        self.group = group
+        g = self.file[group]
+        self.detectors = [HDF5USRBIN(g['det_%s' % i]) for i in range(len(g))]
+
+    def groups(self):
+        return sorted(self.file.keys())
+
+    def __len__(self):
+        return len(self.detectors)
+
+    def __getitem__(self, i):
+        return self.detectors[i]
+
+    def __iter__(self):
+        return iter(self.detectors)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class USRBINData(USRBINBase):
+    """USRBIN detector whose bins, data and errors are already in memory."""
+    def __init__(self, bins, data, errors, name=None, particle=None):
+        self.bins = bins
+        self.data = data
+        self.errors = errors
+        self.name = name
+        self.particle = particle
+
+
+class USRBINCache(object):
+    """
+    On-disk cache of parsed USRBIN files.
+
+    Each source file is stored as one entry directory holding the bins in
+    meta.json and every data/errors matrix as .npy, loaded back memory-mapped
+    (read-only) by default. Entries are keyed by absolute path, size and
+    mtime, or by a SHA-1 of the content with content_hash=True. When the
+    cache grows over max_bytes the least recently used entries are removed.
+    """
+    def __init__(self, path=None, max_bytes=2 ** 30, content_hash=False, mmap_mode='r'):
+        if path is None:
+            path = os.environ.get('FLUKA_DATA_CACHE',
+                                  os.path.join(os.path.expanduser('~'), '.cache', 'fluka_data'))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        self.mmap_mode = mmap_mode
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, fn):
+        h = hashlib.sha1()
+        if self.content_hash:
+            with open(fn, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 24), b''):
+                    h.update(chunk)
+        else:
+            st = os.stat(fn)
+            h.update(('%s|%s|%s' % (os.path.abspath(fn), st.st_size, st.st_mtime_ns)).encode())
+        return h.hexdigest()
 
+    def load(self, fn):
+        entry = os.path.join(self.path, self.key(fn))
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+            data = []
+            for i, det in enumerate(meta['detectors']):
+                bins = [[b[0], b[1], int(b[2]), b[3]] for b in det['bins']]
+                data.append(USRBINData(
+                    bins,
+                    np.load(os.path.join(entry, 'data_%s.npy' % i), mmap_mode=self.mmap_mode),
+                    np.load(os.path.join(entry, 'errors_%s.npy' % i), mmap_mode=self.mmap_mode),
+                    name=det.get('name'), particle=det.get('particle')))
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(entry)  # mark as recently used
+        return data
+
+    def store(self, fn, usrbins, keep=()):
+        key = self.key(fn)
+        entry = os.path.join(self.path, key)
+        tmp = os.path.join(self.path, '.%s.%s' % (key, os.getpid()))
+        os.makedirs(tmp, exist_ok=True)
+        meta = {'source': os.path.abspath(fn), 'detectors': []}
+        for i, usrbin in enumerate(usrbins):
+            np.save(os.path.join(tmp, 'data_%s.npy' % i), np.asarray(usrbin.data))
+            np.save(os.path.join(tmp, 'errors_%s.npy' % i), np.asarray(usrbin.errors))
+            meta['detectors'].append({'bins': usrbin.bins,
+                                      'name': getattr(usrbin, 'name', None),
+                                      'particle': getattr(usrbin, 'particle', None)})
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.replace(tmp, entry)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep)
+
+    def evict(self, keep=()):
+        # keep: absolute source paths whose entries are pinned (a load_usrbins batch)
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
             try:
-                Thickness = float(Thickness)
-                W[i_z, i_y] = Thickness /100
-                print('Wall thickness: %s, decay parameter: %s +- %s' % (round(Thickness), a * 100, np.abs(sk * 2) * 100))
-                lambda_coeff.append(a_min)
-            except Exception:
-                print(i_z, i_y)
-            #else:
-                #W[i_x, i_y] = 2.3
-                #print('Normalno: ', i_x, i_y)
-#plt.imshow(W.T)
-# for seaborn
-W = W.T
-W = np.flip(W,0)
-
-
-import seaborn
-import seaborn as sns
-import pandas as pd
-
-dd = data[-1,:,:]
-dd = np.flip(dd, 0)
-df = pd.DataFrame(dd)
-plt.figure()
-ax = sns.heatmap(W, annot=True, yticklabels=np.round(np.flip(y)), xticklabels=np.round(z), cbar_kws={"label": "Required wall thickness, m"})
-ax.figure.axes[-1].yaxis.label.set_size(16)
-ax.set_xlabel('Z')
-ax.set_ylabel('Y')
-ax.xaxis.label.set_size(18)
-ax.yaxis.label.set_size(18)
-#plt.xticks(x)
-#plt.yticks(y)
-
-ax = plt.figure()
-ax = sns.heatmap(dd*1.0E+6, yticklabels=np.round(np.flip(y)), xticklabels=np.round(z),
-                 cbar_kws={"label": " \u03BCSv/h"})
-ax.figure.axes[-1].yaxis.label.set_size(16)
-ax.set_xlabel('Z')
-ax.set_ylabel('Y')
-ax.xaxis.label.set_size(18)
-ax.yaxis.label.set_size(18)
-#ax.set_yticks(y)
-#sns.heatmap(dd, annot=False, cbar_kws={"label": " \u03BCSv/h"})
-
-
-print('Wall thickness: ', (W))
-print('Lambda koeff.: ', np.max(lambda_coeff), np.min(lambda_coeff))
-
-#plt.semilogy(xd, yd) #/np.max(yd))
-
-#plt.semilogy(xd, yd)
-#plt.semilogy(xd, yd_a)
-
-#plt.plot(xd, a + b*xd)
-
-#print(yd/np.max(yd), yd_a)
-#plt.show()
-"""
-
-
-"""
-##################################################
-#
-# Prompt doses XY
-#
-##################################################
-
-
-# i_y = 4  # 0-10
-# i_x = 17 # 8-20
-
-W = np.zeros((40, 18))
-W = W + 2.3
-lambda_coeff = []
-for i_y in range(0, 18):
-    for i_x in range(0, 40):
-
-        inds = np.where(z > 861)
-        yd = data[i_x, i_y, :][inds]
-        xd = z[inds]
-        Dose_after_wall = yd[-1]
-        Dose_desired = 5.0E-5
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                mtime = os.path.getmtime(entry)
+                if keep:
+                    with open(os.path.join(entry, 'meta.json')) as f:
+                        if json.load(f)['source'] in keep:
+                            total += size
+                            continue
+            except (OSError, ValueError, KeyError):
+                # removed or being removed by another process
+                continue
+            entries.append((mtime, size, entry))
+            total += size
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def get_usrbins(self, fn, mapped=False):
+        data = self.load(fn)
+        if data is None:
+            data = get_usrbins(fn, mapped=mapped)
+            self.store(fn, data)
+        return data
+
+
+def _store_usrbins(args):
+    # pool worker: parse one file into the cache, nothing is sent back
+    cache, fn, mapped, keep = args
+    if cache.load(fn) is None:
+        cache.store(fn, get_usrbins(fn, mapped=mapped), keep=keep)
+    return fn
+
+
+def load_usrbins(files, processes=None, cache=None, mapped=True):
+    """
+    Parse many .bnn.lis (or binary) files on a process pool.
+
+    files is a list of file names or a glob pattern (sorted). The workers
+    write the parsed matrices to a USRBINCache (the default cache if None)
+    and the parent maps them back, so the arrays are shared through the
+    page cache instead of being pickled. Returns one list of detectors per
+    file, in the order of files.
+    The entries of the batch are never evicted by its own stores, so a batch
+    larger than cache.max_bytes overfills the cache until the next store
+    outside the batch trims it.
+    """
+    if isinstance(files, str):
+        files = sorted(glob.glob(files))
+    if cache is None:
+        cache = USRBINCache()
+    keep = frozenset(os.path.abspath(fn) for fn in files)
+    jobs = [(cache, fn, mapped, keep) for fn in files]
+    if processes == 1 or len(jobs) < 2:
+        for job in jobs:
+            _store_usrbins(job)
+    else:
+        # imported here, it is the slowest of the library imports
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_store_usrbins, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    data = []
+    for fn in files:
+        usrbins = cache.load(fn)
+        if usrbins is None:
+            raise IOError("'%s' is missing from the cache '%s' after loading" % (fn, cache.path))
+        data.append(usrbins)
+    return data
 
-        if Dose_after_wall > Dose_desired:
 
-            a, b = np.polyfit(xd, np.log(yd), 1, w=np.sqrt(yd))
+class USRBINMerge(object):
+    """
+    Running weighted merge of USRBIN outputs from independent runs.
+
+    Runs are folded in one at a time with add() or add_file(); only the
+    sums of w, w*x, w*x**2 and w**2*sigma**2 per bin are kept, so memory
+    does not grow with the number of runs. result() gives the weighted mean
+    and its percentage error: with errors='spread' (default) the error of
+    the mean is estimated from the run-to-run spread as usbsuw does, with
+    errors='propagate' the input percentage errors are propagated.
+    """
+    def __init__(self, errors='spread'):
+        if errors not in ('spread', 'propagate'):
+            raise ValueError("errors must be 'spread' or 'propagate', not %r" % errors)
+        self.error_mode = errors
+        self.nruns = 0
+        self.weight = 0.0
+        self.detectors = []
+        self.sum_x = []
+        self.sum_x2 = []
+        self.sum_var = []
+
+    def add(self, usrbins, weight=1.0):
+        # usrbins: all detectors of one run, weight: e.g. its number of primaries
+        # the whole run is checked first, a rejected run leaves the sums untouched
+        if self.nruns:
+            if len(usrbins) != len(self.detectors):
+                raise ValueError("run has %s detectors, expected %s" % (len(usrbins), len(self.detectors)))
+            for i, usrbin in enumerate(usrbins):
+                if not same_binning(usrbin.bins, self.detectors[i].bins):
+                    raise ValueError("detector %s binning %s does not match %s"
+                                     % (i, usrbin.bins, self.detectors[i].bins))
+        for i, usrbin in enumerate(usrbins):
+            x = np.asarray(usrbin.data, dtype=np.float64)
+            var = (x * np.asarray(usrbin.errors, dtype=np.float64) / 100.0) ** 2
+            if self.nruns == 0:
+                self.detectors.append(usrbin)
+                self.sum_x.append(weight * x)
+                self.sum_x2.append(weight * x * x)
+                self.sum_var.append(weight * weight * var)
+                continue
+            self.sum_x[i] += weight * x
+            self.sum_x2[i] += weight * x * x
+            self.sum_var[i] += weight * weight * var
+        self.nruns += 1
+        self.weight += weight
+
+    def add_file(self, fn, weight=1.0):
+        self.add(get_usrbins(fn, mapped=True), weight=weight)
+
+    def result(self):
+        data = []
+        for i, det in enumerate(self.detectors):
+            mean = self.sum_x[i] / self.weight
+            if self.error_mode == 'spread' and self.nruns > 1:
+                var = (self.sum_x2[i] / self.weight - mean * mean) / (self.nruns - 1)
+            else:
+                var = self.sum_var[i] / self.weight ** 2
+            sigma = np.sqrt(np.maximum(var, 0.0))
+            errors = np.zeros_like(mean)
+            np.divide(100.0 * sigma, mean, out=errors, where=mean != 0)
+            data.append(USRBINData(det.bins, mean, np.abs(errors),
+                                   name=getattr(det, 'name', None),
+                                   particle=getattr(det, 'particle', None)))
+        return data
 
-            a,b = np.polyfit(xd, np.log(yd), 1) #, w=np.sqrt(yd))
-            y_a = a*xd + b
-            yd_a = np.exp(a*xd + b)
+    def write(self, fn, title='merged'):
+        write_usrbins_binary(fn, self.result(), title=title, weight=self.weight, ncase=self.nruns)
 
-            # errors :
-            mx = np.average(xd)
-            my = np.average(yd)
-            Dyy = np.sum((np.log(yd) - np.average(np.log(yd)))**2)
-            Dxx = np.sum((xd - np.average(xd))**2)
-            sk = np.sqrt(1/(len(xd)-2) * (Dyy/Dxx - a**2))
 
+def data_3D_slice(usrbin_data,
+            xmin=None, xmax=None,
+            ymin=None, ymax=None,
+            zmin=None, zmax=None):
+    # view of the bins overlapping the ranges, bins are edges (see USRBINGrid)
+    return usrbin_data.data[usrbin_data.grid.slices(xmin, xmax, ymin, ymax, zmin, zmax)]
 
-            inds = np.where( z < 861)
-            Dose_ = data[i_x, i_y, :][inds]
-            Dose_0 = Dose_[-1]
-            #print('Dose inner wall ', Dose_0)
 
-            a_min = a + np.abs(1*sk)
-            Thickness = -(np.log(Dose_0) - np.log(Dose_desired))/a_min
+def data_2D_plot(data, x1, x2 ,proj):
+    pass
 
 
-            try:
-                Thickness = float(Thickness)
-                W[i_x, i_y] = Thickness /100
-                print('Wall thickness: %s, decay parameter: %s +- %s' % (round(Thickness), a * 100, np.abs(sk * 2) * 100))
-                lambda_coeff.append(a_min)
-            except Exception:
-                print(i_x, i_y)
-            #else:
-                #W[i_x, i_y] = 2.3
-                #print('Normalno: ', i_x, i_y)
-
-
-#plt.imshow(W.T)
-# for seaborn
-W = W.T
-W = np.flip(W,0)
-
-
-import seaborn
-import seaborn as sns
-import pandas as pd
-
-dd = data[:,:,-1].T
-dd = np.flip(dd, 0)
-df = pd.DataFrame(dd)
-plt.figure()
-ax = sns.heatmap(W, annot=True, yticklabels=np.round(np.flip(y)), xticklabels=np.round(x), cbar_kws={"label": "Required wall thickness, m"})
-ax.figure.axes[-1].yaxis.label.set_size(16)
-ax.set_xlabel('X')
-ax.set_ylabel('Y')
-ax.xaxis.label.set_size(18)
-ax.yaxis.label.set_size(18)
-#plt.xticks(x)
-#plt.yticks(y)
-
-ax = plt.figure()
-ax = sns.heatmap(dd*1.0E+6, yticklabels=np.round(np.flip(y)), xticklabels=np.round(x),
-                 cbar_kws={"label": " \u03BCSv/h"})
-ax.figure.axes[-1].yaxis.label.set_size(16)
-ax.set_xlabel('X')
-ax.set_ylabel('Y')
-ax.xaxis.label.set_size(18)
-ax.yaxis.label.set_size(18)
-#ax.set_yticks(y)
-#sns.heatmap(dd, annot=False, cbar_kws={"label": " \u03BCSv/h"})
-
-
-print('Wall thickness: ', (W))
-print('Lambda koeff.: ', np.max(lambda_coeff), np.min(lambda_coeff))
-
-#plt.semilogy(xd, yd) #/np.max(yd))
-
-#plt.semilogy(xd, yd)
-#plt.semilogy(xd, yd_a)
-
-#plt.plot(xd, a + b*xd)
-
-#print(yd/np.max(yd), yd_a)
-#plt.show()
-"""
-
-##################################################
-#
-# Residual doses
-#
-##################################################
-
-
-fn = "simple_vault_ns_concr_local_40.bnn.lis"
-fn = "simple_vault_ns_40.bnn.lis"
-
-lines = ascii2lines(fn=fn)
-usrbin = USRBIN(lines)
-usrbin.get_bins()
-
-print(usrbin.bins)
-#print(usrbin.errors)
-
-
-
-from matplotlib import ticker, cm
-import matplotlib.colors as colors
-from matplotlib.colors import LogNorm
-import matplotlib.patches as patches
-
-
-data_ = get_usrbins(fn)
-
-for index in range(5):
-    data = data_[index].data[:, 4, :] # Y = 0
-    data = data +  np.flip(data, 1)
-    print(data.shape)
-    
-    # Dose: Sv/hour
-    data = data*3600*1.0E-12
-
-    bins = data_[4].bins
-    x = np.linspace(bins[0][0], bins[0][1], bins[0][2])
-    y = np.linspace(bins[1][0], bins[1][1], bins[1][2])
-    z = np.linspace(bins[2][0], bins[2][1], bins[2][2])
-
-    xx, zz = np.meshgrid(z, x)
-
-    #print(np.min(data))
-    fig, ax = plt.subplots()
-    #plt.imshow(np.log10(data))
-    #cs = plt.contourf(xx, zz, np.log10(data), 100)
-    levels_ = []
-    for i in range(0, 10):
-        levels_.append(1.0E-7 * 10 ** i)
-        levels_.append(5.0E-7 * 10 ** i)
-    levels_ = np.array(levels_)*1
-    #levels_ = [5.0E-6, 5.0E-5, 5.0E-4]
-    #cs =plt.contourf(xx, zz, data, 500, levels=levels_, cmap=plt.cm.coolwarm, norm=LogNorm())
-    cs  = plt.contourf(xx, zz, data, 500, cmap=plt.cm.jet, norm=LogNorm(), levels=levels_)
-    cbar = plt.colorbar()
-    cbar.ax.set_ylabel('Sv/h')
-    cs2 = plt.contour(cs, levels=[5.0E-5], colors='white', linewidth=4)
-    ax.clabel(cs2, fmt='%2.2e', colors='w', fontsize=18)
-    cs2 = plt.contour(cs, levels=[1.0E-4], colors='gray',  linewidth=4)
-    ax.clabel(cs2, fmt='%2.2e', colors='gray', fontsize=18)
-    #cs1 =plt.contourf(xx, zz, data, 500, cmap=plt.cm.coolwarm, norm=LogNorm())
-    #norm=colors.LogNorm(vmin=5.0E-5/1000, vmax=5.0E-5*1000 ))
-    #ax.set_yticks(x)
-    #ax.set_xticks(z)
-    plt.xlabel('Z, cm')
-    plt.ylabel('X, cm')
-
-    rect = patches.Rectangle((-861,-203),861*2, 203*2,linewidth=2,edgecolor='black',facecolor='none')
-    ax.add_patch(rect)
-
-    #print(np.max(data), np.min(data))
-    plt.savefig(fn + '_' + str(index) +'.jpg', figsize=(27, 9), dpi=180,)
-    
-
-
-plt.show()
-
-#print(np.max(data_[0].data) / np.max(data_[0].data),
-#      np.max(data_[1].data) / np.max(data_[0].data),
-#      np.max(data_[2].data) / np.max(data_[0].data),
-#      np.max(data_[3].data) / np.max(data_[0].data),
-#      np.max(data_[4].data) / np.max(data_[0].data))
-
-#print(data_[4].bins)
+def fit_attenuation(data, coords, boundary, axis=0):
+    """
+    Log-linear fit log(D) = a*x + b along axis for every transverse cell at
+    once, using the points with coords > boundary (behind the wall).
+    Returns the slopes a, intercepts b and slope standard errors sk, each
+    shaped like data without axis. Cells with non-positive doses in the
+    fit range give nan.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    inds = np.where(coords > boundary)[0]
+    if inds.size < 3:
+        raise ValueError("need at least 3 points behind the boundary %s, got %s" % (boundary, inds.size))
+    xd = coords[inds]
+    yd = np.moveaxis(np.take(np.asarray(data, dtype=np.float64), inds, axis=axis), axis, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ly = np.where(yd > 0, np.log(np.where(yd > 0, yd, 1.0)), np.nan)
+    n = xd.size
+    dx = xd - xd.mean()
+    Dxx = np.sum(dx ** 2)
+    dy = ly - ly.mean(axis=-1, keepdims=True)
+    a = np.sum(dx * dy, axis=-1) / Dxx
+    b = ly.mean(axis=-1) - a * xd.mean()
+    Dyy = np.sum(dy ** 2, axis=-1)
+    sk = np.sqrt(np.maximum(1.0 / (n - 2) * (Dyy / Dxx - a ** 2), 0.0))
+    return a, b, sk
+
+
+def wall_thickness(data, coords, boundary, target_dose=5.0E-5, axis=0, nsigma=1.0, default=np.nan):
+    """
+    Wall thickness needed to bring the dose down to target_dose, for every
+    transverse cell of a 3D dose array (same units as coords, e.g. cm).
+
+    The wall starts at coords == boundary along axis. For each cell whose
+    last dose behind the wall exceeds target_dose, the attenuation slope is
+    fitted behind the wall (fit_attenuation), made conservative by nsigma
+    standard errors, and the thickness is solved from the last dose in front
+    of the wall. Other cells get default. Returns the thickness map and a
+    boolean mask of cells that needed a fit but failed it (zero doses,
+    no attenuation, non-finite result).
+    """
+    data = np.asarray(data, dtype=np.float64)
+    coords = np.asarray(coords, dtype=np.float64)
+    inner = np.where(coords < boundary)[0]
+    outer = np.where(coords > boundary)[0]
+    if inner.size == 0:
+        raise ValueError("no points in front of the boundary %s" % boundary)
+    if outer.size == 0:
+        raise ValueError("no points behind the boundary %s" % boundary)
+    dose_0 = np.take(data, inner[-1], axis=axis)
+    dose_after = np.take(data, outer[-1], axis=axis)
+    a, b, sk = fit_attenuation(data, coords, boundary, axis=axis)
+    a_min = a + np.abs(nsigma * sk)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        thickness = -(np.log(dose_0) - np.log(target_dose)) / a_min
+    needed = dose_after > target_dose
+    failed = needed & ~(np.isfinite(thickness) & (a_min < 0) & (dose_0 > 0))
+    thickness = np.where(needed & ~failed, thickness, default)
+    return thickness, failed
+
+
+class ScenarioStack(object):
+    """
+    N scenarios (shielding variants, thresholds...) scored on the same
+    binning, stacked into (scenario, x, y, z) arrays: .data scaled by norm
+    (e.g. 3600*1.0E-12 for pSv/s to Sv/h) and .errors in percent. Every
+    comparison runs over all scenarios at once.
+    """
+    def __init__(self, usrbins, names=None, norm=1.0):
+        usrbins = list(usrbins)
+        if not usrbins:
+            raise ValueError("no scenarios to compare")
+        for i, usrbin in enumerate(usrbins[1:]):
+            if not same_binning(usrbin.bins, usrbins[0].bins):
+                raise ValueError("scenario %s has binning %s, expected %s" % (i + 1, usrbin.bins, usrbins[0].bins))
+        if names is None:
+            names = [getattr(u, 'name', None) or str(i) for i, u in enumerate(usrbins)]
+        self.names = list(names)
+        self.bins = usrbins[0].bins
+        self.grid = USRBINGrid(self.bins)
+        self.data = np.stack([np.asarray(u.data, dtype=np.float64) for u in usrbins]) * norm
+        self.errors = np.stack([np.asarray(u.errors, dtype=np.float64) for u in usrbins])
+
+    @classmethod
+    def from_files(cls, files, detector=0, names=None, norm=1.0, **kwargs):
+        """Stack detector number detector of every file (get_usrbins kwargs), named after the files."""
+        if names is None:
+            names = [os.path.basename(fn).split('.bnn')[0] for fn in files]
+        return cls([get_usrbins(fn, **kwargs)[detector] for fn in files], names=names, norm=norm)
+
+    def index(self, scenario):
+        return self.names.index(scenario) if isinstance(scenario, str) else scenario
+
+    @property
+    def sigma(self):
+        return self.data * self.errors / 100.0
+
+    def ratio(self, reference=0):
+        """
+        Every scenario over the reference one and its percentage error, the
+        relative errors added in quadrature; the reference over itself is
+        exactly 1 with no error. Bins with a zero reference dose are nan.
+        """
+        ref = self.index(reference)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(self.data[ref] != 0, self.data / self.data[ref], np.nan)
+        errors = np.sqrt(self.errors ** 2 + self.errors[ref] ** 2)
+        errors[ref] = 0.0
+        return ratio, np.where(np.isnan(ratio), np.nan, errors)
+
+    def difference(self, reference=0):
+        """
+        Every scenario minus the reference one and its absolute error; the
+        reference minus itself is exactly 0 with no error.
+        """
+        ref = self.index(reference)
+        sigma = self.sigma
+        errors = np.sqrt(sigma ** 2 + sigma[ref] ** 2)
+        errors[ref] = 0.0
+        return self.data - self.data[ref], errors
+
+    def region_maxima(self, regions):
+        """
+        Maximum dose of every scenario in named regions, a dict of
+        (xmin, xmax, ymin, ymax, zmin, zmax) ranges (None for open ends).
+        Returns {region: (max (scenario,), error % (scenario,), position
+        (scenario, 3) of the bin centre)}. A region holding no bin centre
+        raises ValueError.
+        """
+        result = {}
+        for name, ranges in regions.items():
+            s = self.grid.slices(*ranges)
+            block = self.data[(slice(None),) + s]
+            if block[0].size == 0:
+                raise ValueError("region %s %s holds no bin centre" % (name, tuple(ranges)))
+            n = block.shape[0]
+            i = np.argmax(block.reshape(n, -1), axis=1)
+            ix, iy, iz = np.unravel_index(i, block.shape[1:])
+            scen = np.arange(n)
+            errors = self.errors[(slice(None),) + s][scen, ix, iy, iz]
+            position = np.stack([self.grid.centres[0][s[0]][ix],
+                                 self.grid.centres[1][s[1]][iy],
+                                 self.grid.centres[2][s[2]][iz]], axis=1)
+            result[name] = (block[scen, ix, iy, iz], errors, position)
+        return result
+
+    def wall_thickness(self, boundary, target_dose=5.0E-5, axis=0, nsigma=1.0, default=np.nan):
+        """
+        wall_thickness maps of all scenarios in one pass, (scenario, ...)
+        shaped; target_dose may be one value or one per scenario. Returns
+        the maps, the failed masks and the largest thickness per scenario.
+        """
+        target = np.asarray(target_dose, dtype=np.float64)
+        if target.ndim:
+            target = target.reshape((-1, 1, 1))
+        thickness, failed = wall_thickness(self.data, self.grid.centres[axis], boundary,
+                                           target_dose=target, axis=axis + 1, nsigma=nsigma,
+                                           default=default)
+        with np.errstate(invalid='ignore'):
+            finite = np.where(np.isfinite(thickness), thickness, -np.inf)
+            required = finite.reshape(len(self.names), -1).max(axis=1)
+        return thickness, failed, np.where(np.isfinite(required), required, default)
+
+
+def gamma_dose_constant(gamma, k=1.4E-13):
+    """
+    Point-source gamma dose-rate constant, Sv m^2 / (h Bq), of a TORI gamma
+    table of (energy keV, intensity %, ...) lines: k * sum(E[MeV] * I).
+    k ~ 1.4e-13 reproduces Co-60 (3.5e-13) and Cs-137 within ~20%.
+    """
+    if len(gamma) == 0:
+        return 0.0
+    e = np.array([line[0] for line in gamma], dtype=np.float64) * 1.0E-3
+    i = np.array([line[1] for line in gamma], dtype=np.float64) / 100.0
+    return k * np.sum(e * i)
+
+
+class DecayDoseEngine(object):
+    """
+    Residual dose rates of a nuclide inventory at many cooling times.
+
+    Every quantity is evaluated for all cooling times and nuclides at once:
+    decay() is the (time x nuclide) matrix exp(-lambda*t), dose_rates()
+    scales it by initial activities and gamma constants, and dose_map()
+    contracts it with per-nuclide dose maps into a (time x mesh) array.
+    fit_maps() recovers those maps from the dose meshes scored at a few
+    fixed cooling times, so other times need no new FLUKA run.
+    Times are in seconds.
+    """
+    def __init__(self, names, half_lives, gamma_constants=None):
+        self.names = list(names)
+        self.half_lives = np.array([np.inf if t is None else t for t in half_lives], dtype=np.float64)
+        self.decay_constants = np.log(2.0) / self.half_lives
+        if gamma_constants is None:
+            gamma_constants = np.ones(len(self.names))
+        self.gamma_constants = np.asarray(gamma_constants, dtype=np.float64)
+
+    @classmethod
+    def from_records(cls, records, k=1.4E-13):
+        """
+        Engine for TORI_Record objects (half-life and gamma table of each).
+        Stable nuclides never decay; a half-life that is given but cannot
+        be read raises ValueError.
+        """
+        names = ['%s%s' % (r.name, r.mass) for r in records]
+        half_lives = []
+        for name, r in zip(names, records):
+            t = r.half_life_seconds()
+            if t is None and r.half_life and not r.is_stable():
+                raise ValueError("cannot read the half-life '%s' of %s" % (r.half_life_text(), name))
+            half_lives.append(t)
+        return cls(names, half_lives, [gamma_dose_constant(r.gamma, k=k) for r in records])
+
+    def decay(self, times):
+        return np.exp(-np.outer(np.atleast_1d(times), self.decay_constants))
+
+    def activities(self, a0, times):
+        return self.decay(times) * np.asarray(a0, dtype=np.float64)
+
+    def dose_rates(self, a0, times, distance=1.0):
+        """(time x nuclide) dose rates, Sv/h, of point sources a0 (Bq) at distance (m)."""
+        return self.activities(a0, times) * self.gamma_constants / distance ** 2
+
+    def dose_map(self, maps, times):
+        """(time x mesh) dose from maps, the (nuclide x mesh) dose at zero cooling time."""
+        return np.tensordot(self.decay(times), np.asarray(maps), axes=(1, 0))
+
+    def fit_maps(self, cooling_times, doses):
+        """
+        Least-squares (nuclide x mesh) maps from doses, a (time x mesh) stack
+        scored at cooling_times, e.g. the residual-dose detectors of one
+        .lis file. Needs at least as many cooling times as nuclides.
+        """
+        doses = np.asarray(doses, dtype=np.float64)
+        e = self.decay(cooling_times)
+        if e.shape[0] < e.shape[1]:
+            raise ValueError("%s cooling times cannot resolve %s nuclides" % e.shape)
+        maps = np.linalg.lstsq(e, doses.reshape(doses.shape[0], -1), rcond=None)[0]
+        return maps.reshape((e.shape[1],) + doses.shape[1:])
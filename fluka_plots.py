@@ -0,0 +1,124 @@
+import multiprocessing
+import numpy as np
+
+
+# (dose, colour) of the isodose lines drawn over the dose maps, Sv/h
+ISODOSES = ((5.0E-5, 'white'), (1.0E-4, 'gray'))
+
+
+def log_levels(vmin=1.0E-7, decades=10):
+    # 1, 5, 10, 50, ... x vmin
+    levels = []
+    for i in range(0, decades):
+        levels.append(vmin * 10 ** i)
+        levels.append(5 * vmin * 10 ** i)
+    return np.array(levels)
+
+
+class RenderJob(object):
+    """
+    One figure: a 2D map (rows along the vertical axis), the bin centres of
+    its horizontal and vertical axes and the output file. kind='dose' draws
+    log-scaled filled contours with isodose lines, kind='map' a plain
+    colour map (e.g. a wall-thickness map).
+    """
+    def __init__(self, fn, values, h, v, hlabel='Z, cm', vlabel='X, cm',
+                 kind='dose', label='Sv/h', rect=None):
+        self.fn = fn
+        self.values = np.asarray(values, dtype=np.float64)
+        self.h = np.asarray(h, dtype=np.float64)
+        self.v = np.asarray(v, dtype=np.float64)
+        self.hlabel = hlabel
+        self.vlabel = vlabel
+        self.kind = kind
+        self.label = label
+        self.rect = rect
+
+
+def dose_job(usrbin, plane, fn, norm=1.0, rect=None):
+    """
+    RenderJob for the plane (axis, index) of a USRBIN, e.g. (1, 4) for
+    data[:, 4, :], scaled by norm. rect=(h0, v0, width, height) outlines
+    the shielding.
+    """
+    axis, index = plane
+    p, q = [a for a in range(3) if a != axis]
+    values = np.take(np.asarray(usrbin.data), index, axis=axis) * norm
+    g = usrbin.grid
+    return RenderJob(fn, values, g.centres[q], g.centres[p],
+                     hlabel='%s, cm' % 'XYZ'[q], vlabel='%s, cm' % 'XYZ'[p], rect=rect)
+
+
+def map_job(fn, values, h, v, hlabel, vlabel, label):
+    return RenderJob(fn, values, h, v, hlabel=hlabel, vlabel=vlabel, kind='map', label=label)
+
+
+_worker = {}
+
+
+def _init_worker(levels, isodoses, dpi):
+    _worker['levels'] = levels
+    _worker['isodoses'] = isodoses
+    _worker['dpi'] = dpi
+    _worker['meshes'] = {}
+
+
+def _render(job):
+    # a bare Figure on an Agg canvas: no pyplot state, the backend of the
+    # calling process is left alone
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.colors import LogNorm
+    from matplotlib.patches import Rectangle
+
+    # meshgrids are shared by all jobs on the same binning
+    key = (job.h.tobytes(), job.v.tobytes())
+    if key not in _worker['meshes']:
+        _worker['meshes'][key] = np.meshgrid(job.h, job.v)
+    hh, vv = _worker['meshes'][key]
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if job.kind == 'dose':
+        values = np.ma.masked_less_equal(job.values, 0.0)
+        cs = ax.contourf(hh, vv, values, cmap='jet', norm=LogNorm(),
+                         levels=_worker['levels'])
+        cbar = fig.colorbar(cs, ax=ax)
+        cbar.ax.set_ylabel(job.label)
+        for level, color in _worker['isodoses']:
+            if np.nanmin(job.values) < level < np.nanmax(job.values):
+                cs2 = ax.contour(hh, vv, values, levels=[level], colors=color, linewidths=2)
+                ax.clabel(cs2, fmt='%2.2e', colors=color, fontsize=18)
+    else:
+        pc = ax.pcolormesh(hh, vv, job.values, shading='nearest')
+        cbar = fig.colorbar(pc, ax=ax)
+        cbar.ax.set_ylabel(job.label)
+    if job.rect is not None:
+        h0, v0, width, height = job.rect
+        ax.add_patch(Rectangle((h0, v0), width, height, linewidth=2,
+                               edgecolor='black', facecolor='none'))
+    ax.set_xlabel(job.hlabel)
+    ax.set_ylabel(job.vlabel)
+    fig.savefig(job.fn, dpi=_worker['dpi'])
+    return job.fn
+
+
+def render(jobs, processes=None, levels=None, isodoses=ISODOSES, dpi=180):
+    """
+    Render RenderJobs on Agg canvases in a pool of processes and return
+    the written file names in job order. processes=1 renders in this
+    process; pyplot and its backend are not touched either way.
+    """
+    if levels is None:
+        levels = log_levels()
+    initargs = (levels, isodoses, dpi)
+    if processes == 1:
+        _init_worker(*initargs)
+        return [_render(job) for job in jobs]
+    pool = multiprocessing.Pool(processes, _init_worker, initargs)
+    try:
+        return pool.map(_render, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
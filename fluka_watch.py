@@ -0,0 +1,152 @@
+import os
+import sys
+import glob
+import json
+import argparse
+from time import time, sleep
+import numpy as np
+from fluka_data import say, USRBINMerge, wall_thickness
+from fluka_batch import load_config
+from fluka_plots import ISODOSES
+
+
+class CycleWatcher(object):
+    """
+    Follows a FLUKA output directory and folds every new cycle file into a
+    running USRBINMerge as it lands; files already merged are never read
+    again. After each poll that merged something, the derived products of
+    the merged detector are refreshed: wall-thickness maps for the config
+    walls and isodose lines of the first config slice (see
+    fluka_batch.DEFAULT_CONFIG), saved in out_dir if given.
+
+    A file is taken once it has not been modified for settle seconds;
+    FLUKA writers that rename finished files in place can use settle=0.
+    A file that fails to parse is retried when it changes.
+    """
+    def __init__(self, directory, config=None, pattern='*_fort.21', detector=0,
+                 errors='spread', out_dir=None, settle=2.0, callback=None):
+        self.directory = directory
+        self.config = load_config() if config is None else config
+        self.pattern = pattern
+        self.detector = detector
+        self.out_dir = out_dir
+        self.settle = settle
+        self.callback = callback
+        self.merge = USRBINMerge(errors)
+        self.files = []
+        self.failed = {}
+        self.products = None
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+
+    def ready(self):
+        # new files old enough to be complete, in name order
+        files = []
+        now = time()
+        merged = set(self.files)
+        for fn in sorted(glob.glob(os.path.join(self.directory, self.pattern))):
+            if fn in merged:
+                continue
+            try:
+                mtime = os.path.getmtime(fn)
+            except OSError:
+                continue
+            if now - mtime < self.settle or self.failed.get(fn) == mtime:
+                continue
+            files.append((fn, mtime))
+        return files
+
+    def poll(self):
+        """Merge the files that became ready and update the products; returns them."""
+        added = []
+        for fn, mtime in self.ready():
+            try:
+                self.merge.add_file(fn)
+            except (IOError, ValueError) as e:
+                say("WARNING: cannot merge '%s': %s" % (fn, e))
+                self.failed[fn] = mtime
+                continue
+            self.failed.pop(fn, None)
+            self.files.append(fn)
+            added.append(fn)
+        if added:
+            self.update()
+        return added
+
+    def update(self):
+        config = self.config
+        usrbin = self.merge.result()[self.detector]
+        if config['symmetry']:
+            usrbin = usrbin.folded(*config['symmetry'])
+        data = np.asarray(usrbin.data) * config['norm']
+        g = usrbin.grid
+        thickness = {}
+        for wall, (axis, boundary) in sorted(config['walls'].items()):
+            if g.lower[axis] < boundary < g.upper[axis]:
+                try:
+                    thickness[wall] = wall_thickness(data, g.centres[axis], boundary,
+                                                     target_dose=config['target_dose'], axis=axis)
+                except ValueError as e:
+                    say("WARNING: wall %s: %s" % (wall, e))
+        isodoses = {}
+        if config['slices']:
+            isodoses = usrbin.isodose_lines(tuple(config['slices'][0]),
+                                            [level for level, color in ISODOSES], norm=config['norm'])
+        self.products = {'nruns': self.merge.nruns, 'files': list(self.files),
+                         'merged': usrbin, 'thickness': thickness, 'isodoses': isodoses}
+        if self.out_dir is not None:
+            self.save()
+        if self.callback is not None:
+            self.callback(self.products)
+
+    def save(self):
+        p = self.products
+        status = {'nruns': p['nruns'], 'files': p['files'], 'time': time(), 'max_thickness': {}}
+        for wall, (thickness, failed) in p['thickness'].items():
+            np.save(os.path.join(self.out_dir, 'thickness_%s.npy' % wall), thickness)
+            finite = thickness[np.isfinite(thickness)]
+            status['max_thickness'][wall] = float(finite.max()) if finite.size else None
+        for level, segments in p['isodoses'].items():
+            np.save(os.path.join(self.out_dir, 'isodose_%.2e.npy' % level), segments)
+        self.merge.write(os.path.join(self.out_dir, 'merged.bnn'))
+        tmp = os.path.join(self.out_dir, 'status.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(status, f, indent=1)
+        os.replace(tmp, os.path.join(self.out_dir, 'status.json'))
+
+    def watch(self, interval=10.0, timeout=None, max_files=None):
+        """Poll every interval seconds until timeout seconds pass or max_files are merged."""
+        t0 = time()
+        while True:
+            added = self.poll()
+            if added:
+                say("merged %s file(s), %s runs in total" % (len(added), self.merge.nruns))
+            if max_files is not None and len(self.files) >= max_files:
+                break
+            if timeout is not None and time() - t0 >= timeout:
+                break
+            sleep(interval)
+        return self.products
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge FLUKA cycle outputs as they appear.')
+    parser.add_argument('directory')
+    parser.add_argument('--pattern', default='*_fort.21')
+    parser.add_argument('--config', help='JSON file overriding fluka_batch.DEFAULT_CONFIG')
+    parser.add_argument('--detector', type=int, default=0)
+    parser.add_argument('--errors', default='spread', choices=('spread', 'propagate'))
+    parser.add_argument('--out', help='output directory (default: DIRECTORY/watch)')
+    parser.add_argument('--interval', type=float, default=10.0)
+    parser.add_argument('--settle', type=float, default=2.0)
+    parser.add_argument('--timeout', type=float)
+    parser.add_argument('--max-files', type=int)
+    args = parser.parse_args(argv)
+
+    watcher = CycleWatcher(args.directory, load_config(args.config), args.pattern, args.detector,
+                           args.errors, args.out or os.path.join(args.directory, 'watch'), args.settle)
+    watcher.watch(args.interval, args.timeout, args.max_files)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
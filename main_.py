@@ -1,12 +1,16 @@
 from bs4 import BeautifulSoup
+from html import unescape
+import numpy as np
 import requests
+import sqlite3
+import glob
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 import re
 
-ref = "http://nucleardata.nuclear.lu.se/toi/nuclide.asp?iZA=550134"
-page = requests.get(ref)
-
-status = str(page.status_code)
 
 def parse_row(row):
     print(row.replace('<',''))
@@ -23,8 +27,75 @@ def parse_row(row):
 # 7. X-ray table    (ascii)
 # 8. Beta table     (ascii)
 
+# fast parser: rows are split on <tr, cells run to the next cell or row tag
+tori_row = re.compile("<tr\\b", re.I)
+tori_cell = re.compile("<(t[hd])\\b[^>]*>(.*?)(?=</?t[hdr]\\b|</table|$)", re.I | re.S)
+tori_tag = re.compile("<[^>]*>")
+tori_number = re.compile("(-*)([\\d]+)(\\.*)([\\d]*)(E*)(e*)(D*)(d*)([+]*)([-]*)([\\d]*)")
+tori_tables = (("Gammas from", 'gamma'), ("X-rays from", 'xray'), ("Betas from", 'beta'))
+tori_line_dtype = [('energy', 'f8'), ('intensity', 'f8'), ('mode', 'U16')]
+
+
+def parse_tori_html(html):
+    """
+    Single regex pass over a TORI page. Returns a dict with half_life (raw
+    cells, as TORI_Record), charge and mass (int), name and the gamma, xray
+    and beta tables as record arrays of (energy, intensity, mode).
+    """
+    if isinstance(html, bytes):
+        try:
+            html = html.decode('utf-8')
+        except UnicodeDecodeError:
+            html = html.decode('latin-1')
+    heads = []
+    data = []
+    for row in tori_row.split(html)[1:]:
+        h = []
+        d = []
+        for tag, text in tori_cell.findall(row):
+            parts = unescape(tori_tag.sub('', text)).split('\xa0')
+            if tag.lower() == 'th':
+                h.extend(parts)
+            else:
+                d.append(parts)
+        heads.append(h or [''])
+        data.append(d)
+
+    def to_int(value):
+        digits = re.sub("[^\\d]", '', value)
+        return int(digits) if digits else None
+
+    record = {'half_life': None, 'charge': None, 'mass': None, 'name': None}
+    lines = dict((key, []) for title, key in tori_tables)
+    i = 0
+    while i < len(data):
+        h = heads[i]
+        if "Half life: " in h:
+            record['half_life'] = data[i]
+            record['charge'] = to_int(heads[i - 2][0])
+            record['mass'] = to_int(heads[i - 3][0])
+            record['name'] = heads[i - 3][1]
+        for title, key in tori_tables:
+            if title in h[0]:
+                i += 3     # skip header
+                while i < len(data) and len(data[i]) >= 3:
+                    d = data[i]
+                    lines[key].append((float(tori_number.search(d[0][0].replace(',', '.'))[0]),
+                                       float(tori_number.search(d[1][0].replace(',', '.'))[0]),
+                                       ''.join(d[2][:2])))
+                    i += 1
+                i -= 1
+        i += 1
+    for title, key in tori_tables:
+        record[key] = np.array(lines[key], dtype=tori_line_dtype)
+    return record
+
+
 class TORI_Record():
-    def __init__(self, url):
+    time_units = {'y': 31556952., 'd': 86400., 'h': 3600., 'm': 60., 'min': 60., 's': 1.,
+                  'ms': 1.0E-3, 'us': 1.0E-6, '\u03bcs': 1.0E-6, '\xb5s': 1.0E-6, 'ns': 1.0E-9, 'ps': 1.0E-12}
+
+    def __init__(self, url, html=None, fast=False):
         """
         data format for Sqlite database:
         columns (data type)
@@ -36,14 +107,24 @@ class TORI_Record():
         6. Gamma table    (ascii)
         7. X-ray table    (ascii)
         8. Beta table     (ascii)
+
+        html: content of a saved TORI page; the url is not downloaded then.
+        fast: parse with parse_tori_html instead of BeautifulSoup; charge and
+        mass are int and the tables record arrays.
         """
         self.url = url
         #
         any_number_pattern = "(-*)([\d]+)(\.*)([\d]*)(E*)(e*)(D*)(d*)([+]*)([-]*)([\d]*)"
         self.any_number = re.compile(any_number_pattern)
         #
-        self.page = requests.get(url)
-        self.soup = BeautifulSoup(self.page.content, 'html.parser')
+        if html is None:
+            self.page = requests.get(url)
+            self.status_code = self.page.status_code
+            html = self.page.content
+        else:
+            self.page = None
+            self.status_code = 200
+        self.html = html
         #
         # data tables
         self.gamma =[]
@@ -53,7 +134,15 @@ class TORI_Record():
         self.charge     = None
         self.mass       = None
         self.name       = None
-        self.init_()
+        if fast:
+            self.soup = None
+            if str(self.status_code)[0] != '2':
+                print("Error page download: %s"%self.url)
+            else:
+                self.__dict__.update(parse_tori_html(html))
+        else:
+            self.soup = BeautifulSoup(html, 'html.parser')
+            self.init_()
 
 
     def parse_table(self, table):
@@ -69,6 +158,8 @@ class TORI_Record():
 
 
     def __str__(self):
+        if self.soup is None:
+            return str(self.html)
         return self.soup.prettify()
 
 
@@ -90,7 +181,7 @@ class TORI_Record():
                 a3 = d[2][0] + d[2][1]
             return a1, a2, a3
 
-        if str(self.page.status_code)[0] != '2':
+        if str(self.status_code)[0] != '2':
             print("Error page download: %s"%self.url)
         else:
             tables = self.soup.find_all("table")
@@ -139,17 +230,216 @@ class TORI_Record():
                         d = get_next_data_line(data, i)
                     i -= 1
                 i += 1
-                sec_year = 31556952.
-                sec_day = 86400.
-                sec_hour = 3600.
 
+    def half_life_text(self):
+        if not self.half_life:
+            return ''
+        return ' '.join(' '.join(d) for d in self.half_life).replace(',', '.')
+
+    def is_stable(self):
+        # TORI writes 'stable' in the half-life cell
+        return 'stable' in self.half_life_text().lower()
+
+    def half_life_seconds(self):
+        # e.g. [['2.0648 y', '10']] -> 6.516e7, None for stable or unknown
+        text = self.half_life_text()
+        if not text:
+            return None
+        m = re.search(r"([\d]+\.*[\d]*(E[+-]*[\d]+)*) *(%s)\b" % '|'.join(self.time_units), text)
+        if m is None:
+            return None
+        return float(m.group(1)) * self.time_units[m.group(3)]
+
+
+class TORI_DB():
+    """
+    Local SQLite store of TORI records, following the TORI_Record schema:
+    nuclides (name, charge, mass, t_half in s, html) and the gamma, X-ray
+    and beta tables (energy, intensity, mode). Nuclides are indexed by
+    (charge, mass) and the lines by energy, so queries run offline.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS nuclides (
+            id INTEGER PRIMARY KEY, url TEXT UNIQUE, name TEXT,
+            charge INTEGER, mass INTEGER, t_half REAL, html TEXT);
+        CREATE INDEX IF NOT EXISTS nuclides_za ON nuclides (charge, mass);
+    """
+    line_tables = ('gamma', 'xray', 'beta')
+
+    def __init__(self, fn):
+        self.fn = fn
+        # transactions are opened explicitly, see add_records
+        self.connection = sqlite3.connect(fn, isolation_level=None)
+        script = self.schema
+        for table in self.line_tables:
+            script += """
+        CREATE TABLE IF NOT EXISTS %s (
+            nuclide_id INTEGER REFERENCES nuclides (id) ON DELETE CASCADE,
+            energy REAL, intensity REAL, mode TEXT);
+        CREATE INDEX IF NOT EXISTS %s_energy ON %s (energy, intensity);
+        CREATE INDEX IF NOT EXISTS %s_nuclide ON %s (nuclide_id);
+            """ % (table, table, table, table, table)
+        self.connection.executescript(script)
+
+    @staticmethod
+    def to_int(value):
+        if isinstance(value, int):
+            return value
+        try:
+            return int(re.sub(r"[^\d]", '', value))
+        except (TypeError, ValueError):
+            return None
+
+    def insert(self, record):
+        # one record, inside the caller's transaction
+        c = self.connection
+        for (old_id,) in c.execute("SELECT id FROM nuclides WHERE url = ?", (record.url,)).fetchall():
+            for table in self.line_tables:
+                c.execute("DELETE FROM %s WHERE nuclide_id = ?" % table, (old_id,))
+            c.execute("DELETE FROM nuclides WHERE id = ?", (old_id,))
+        html = record.html.decode('utf-8', 'replace') if isinstance(record.html, bytes) else record.html
+        cur = c.execute("INSERT INTO nuclides (url, name, charge, mass, t_half, html) VALUES (?, ?, ?, ?, ?, ?)",
+                        (record.url, record.name, self.to_int(record.charge), self.to_int(record.mass),
+                         record.half_life_seconds(), html))
+        nuclide_id = cur.lastrowid
+        for table in self.line_tables:
+            c.executemany("INSERT INTO %s (nuclide_id, energy, intensity, mode) VALUES (?, ?, ?, ?)" % table,
+                          [(nuclide_id,) + tuple(line) for line in getattr(record, table)])
+
+    def add_records(self, records, batch_size=500):
+        n = 0
+        c = self.connection
+        c.execute("BEGIN")
+        try:
+            for record in records:
+                self.insert(record)
+                n += 1
+                if n % batch_size == 0:
+                    c.execute("COMMIT")
+                    c.execute("BEGIN")
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        return n
+
+    def add_html_dir(self, path, pattern='*.html', batch_size=500,
+                     url="http://nucleardata.nuclear.lu.se/toi/nuclide.asp?iZA=%s"):
+        """Ingest saved pages named after their iZA code, e.g. 550134.html."""
+        def records():
+            for fn in sorted(glob.glob(os.path.join(path, pattern))):
+                iza = re.sub(r"[^\d]", '', os.path.basename(fn))
+                with open(fn, 'rb') as f:
+                    yield TORI_Record(url % iza, html=f.read())
+        return self.add_records(records(), batch_size=batch_size)
+
+    def nuclide(self, charge, mass):
+        return self.connection.execute(
+            "SELECT id, name, charge, mass, t_half FROM nuclides WHERE charge = ? AND mass = ?",
+            (charge, mass)).fetchall()
+
+    def lines(self, table, emin, emax, min_intensity=0.0):
+        """(name, charge, mass, t_half, energy, intensity) of lines between emin and emax keV."""
+        if table not in self.line_tables:
+            raise ValueError("table must be one of %s" % (self.line_tables,))
+        return self.connection.execute(
+            "SELECT n.name, n.charge, n.mass, n.t_half, l.energy, l.intensity FROM %s l "
+            "JOIN nuclides n ON n.id = l.nuclide_id "
+            "WHERE l.energy BETWEEN ? AND ? AND l.intensity > ? ORDER BY l.energy" % table,
+            (emin, emax, min_intensity)).fetchall()
+
+    def gamma_lines(self, emin, emax, min_intensity=0.0):
+        return self.lines('gamma', emin, emax, min_intensity)
+
+    def close(self):
+        self.connection.close()
+
+
+class TORI_Crawler():
+    """
+    Bulk downloader of TORI pages over a range of iZA codes.
+
+    Pages are fetched by a pool of max_workers threads, at most rate
+    requests per second in total, with retries and exponential backoff on
+    connection errors, 429 and 5xx answers. Each page is saved as
+    out_dir/<iZA>.html (the layout TORI_DB.add_html_dir reads) and its
+    status is written to out_dir/checkpoint.json, so an interrupted crawl
+    resumes with the codes not done yet. url is a template with one %s
+    for the code, e.g. a local test server.
+    """
+    url = "http://nucleardata.nuclear.lu.se/toi/nuclide.asp?iZA=%s"
+
+    def __init__(self, out_dir, url=None, max_workers=4, rate=5.0, retries=3, backoff=1.0, timeout=30.0):
+        self.out_dir = out_dir
+        if url is not None:
+            self.url = url
+        self.max_workers = max_workers
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        os.makedirs(out_dir, exist_ok=True)
+        self.checkpoint_fn = os.path.join(out_dir, 'checkpoint.json')
+        self.done = {}
+        if os.path.exists(self.checkpoint_fn):
+            with open(self.checkpoint_fn) as f:
+                self.done = json.load(f)
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait_turn(self):
+        # rate limit shared by all threads
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + 1.0 / self.rate
+        time.sleep(max(0.0, start - now))
+
+    def fetch(self, iza):
+        """(status code, content) of one page, (None, None) if all attempts failed."""
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            self.wait_turn()
+            try:
+                page = requests.get(self.url % iza, timeout=self.timeout)
+            except requests.RequestException:
+                continue
+            if page.status_code != 429 and page.status_code < 500:
+                return page.status_code, page.content
+        return None, None
 
-#class TORI_DB()
+    def save(self, iza, status, content):
+        if str(status)[0] == '2':
+            fn = os.path.join(self.out_dir, '%s.html' % iza)
+            with open(fn + '.tmp', 'wb') as f:
+                f.write(content)
+            os.replace(fn + '.tmp', fn)
+        self.done[str(iza)] = status
+        with open(self.checkpoint_fn + '.tmp', 'w') as f:
+            json.dump(self.done, f)
+        os.replace(self.checkpoint_fn + '.tmp', self.checkpoint_fn)
 
+    def crawl(self, izas):
+        """Fetch every code of izas not in the checkpoint; returns the codes that failed."""
+        todo = [iza for iza in izas if str(iza) not in self.done]
+        failed = []
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures = dict((pool.submit(self.fetch, iza), iza) for iza in todo)
+            for future in as_completed(futures):
+                iza = futures[future]
+                status, content = future.result()
+                if status is None:
+                    print("Error page download: %s" % (self.url % iza))
+                    failed.append(iza)
+                else:
+                    self.save(iza, status, content)
+        return sorted(failed)
 
 
-ref = "http://nucleardata.nuclear.lu.se/toi/nuclide.asp?iZA=550134"
-t = TORI_Record(ref)
+if __name__ == '__main__':
+    ref = "http://nucleardata.nuclear.lu.se/toi/nuclide.asp?iZA=550134"
+    t = TORI_Record(ref)
 #print(t.half_life, t.charge, t.mass,  t.name)
 #print(t.gamma)
 #html = t.soup.prettify()
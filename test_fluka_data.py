@@ -0,0 +1,97 @@
+import numpy as np
+from fluka_data import get_usrbins, fit_attenuation, wall_thickness, contour_segments, isosurface_triangles
+
+
+NORM = (1.2E+5 / 4.0E+7) * 6.2415E+18 * 1.0E-12 * 3600
+
+
+def loop_thickness(data, x, boundary, target):
+    # the per-cell polyfit loop of vault_analysis.py, along X
+    thickness = {}
+    slopes = {}
+    for i_y in range(data.shape[1]):
+        for i_z in range(data.shape[2]):
+            inds = np.where(x > boundary)
+            yd = data[:, i_y, i_z][inds]
+            xd = x[inds]
+            if yd[-1] > target:
+                # zero doses behind the wall give nan, as they did in the script
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    a, b = np.polyfit(xd, np.log(yd), 1)
+                    Dyy = np.sum((np.log(yd) - np.average(np.log(yd))) ** 2)
+                    Dxx = np.sum((xd - np.average(xd)) ** 2)
+                    sk = np.sqrt(1 / (len(xd) - 2) * (Dyy / Dxx - a ** 2))
+                    dose_0 = data[:, i_y, i_z][np.where(x < boundary)][-1]
+                    a_min = a + np.abs(sk)
+                    thickness[i_y, i_z] = -(np.log(dose_0) - np.log(target)) / a_min
+                slopes[i_y, i_z] = (a, b, sk)
+    return thickness, slopes
+
+
+def test_wall_thickness_matches_loop():
+    usrbin = get_usrbins('simple_vault_ns_concr_local_30.bnn.lis')[0]
+    bins = usrbin.bins
+    x = np.linspace(bins[0][0], bins[0][1], bins[0][2])
+    data = usrbin.data * NORM
+    data = data + np.flip(data, 2)
+    expected, slopes = loop_thickness(data, x, 203.0, 5.0E-5)
+    fitted = [cell for cell, value in expected.items() if np.isfinite(value)]
+    assert len(fitted) == 230
+
+    thickness, failed = wall_thickness(data, x, 203.0, target_dose=5.0E-5)
+    a, b, sk = fit_attenuation(data, x, 203.0)
+    for cell in fitted:
+        np.testing.assert_allclose(thickness[cell], expected[cell], rtol=1.0E-9)
+        np.testing.assert_allclose((a[cell], b[cell], sk[cell]), slopes[cell], rtol=1.0E-9)
+    # the cells the loop could not fit are flagged, no other cell gets a value
+    assert sorted(zip(*np.nonzero(failed))) == sorted(set(expected) - set(fitted))
+    assert np.count_nonzero(np.isfinite(thickness)) == len(fitted)
+
+
+def test_contour_segments_match_matplotlib():
+    from matplotlib.figure import Figure
+
+    u = np.linspace(-2.0, 2.0, 41)
+    v = np.linspace(-3.0, 3.0, 53)
+    values = np.exp(-u[:, None] ** 2 - 0.5 * v ** 2) + 0.3 * np.sin(3 * u)[:, None] * np.cos(2 * v)
+    segments = contour_segments(values, u, v, 0.4)
+    # matplotlib takes the columns as x: its lines are (v, u)
+    lines = [line[:, ::-1] for line in Figure().add_subplot().contour(v, u, values, levels=[0.4]).allsegs[0]]
+    points = np.concatenate(lines)
+    ends = segments.reshape(-1, 2)
+    distance = np.abs(ends[:, None, :] - points[None, :, :]).max(axis=-1)
+    assert distance.min(axis=1).max() < 1.0E-13
+    assert distance.min(axis=0).max() < 1.0E-13
+    length = sum(np.linalg.norm(np.diff(line, axis=0), axis=1).sum() for line in lines)
+    np.testing.assert_allclose(np.linalg.norm(segments[:, 1] - segments[:, 0], axis=1).sum(), length, rtol=1.0E-12)
+
+
+def test_contour_segments_circle():
+    x = np.linspace(-1.5, 1.5, 61)
+    r = np.hypot(x[:, None], x)
+    segments = contour_segments(r, x, x, 1.0)
+    np.testing.assert_allclose(np.linalg.norm(segments, axis=2), 1.0, atol=1.0E-3)
+    np.testing.assert_allclose(np.linalg.norm(segments[:, 1] - segments[:, 0], axis=1).sum(), 2 * np.pi, rtol=1.0E-3)
+
+
+def test_contour_segments_saddle():
+    # corners 0 and 2 (at (0, 0) and (1, 1)) above, 1 and 3 below
+    values = np.array([[1.0, 0.0], [0.0, 1.0]])
+    x = np.array([0.0, 1.0])
+    # the cell mean is above: 0 and 2 are joined, the segments cut off 1 and 3
+    segments = contour_segments(values, x, x, 0.5)
+    assert sorted(map(sorted, segments.tolist())) == [[[0.0, 0.5], [0.5, 1.0]], [[0.5, 0.0], [1.0, 0.5]]]
+    # the cell mean is below: the segments cut off 0 and 2
+    segments = contour_segments(values, x, x, 0.6)
+    expected = [[[0.0, 0.4], [0.4, 0.0]], [[0.6, 1.0], [1.0, 0.6]]]
+    np.testing.assert_allclose(sorted(map(sorted, segments.tolist())), expected, atol=1.0E-15)
+
+
+def test_isosurface_triangles_sphere():
+    x = np.linspace(-1.5, 1.5, 41)
+    r = np.sqrt(x[:, None, None] ** 2 + x[None, :, None] ** 2 + x ** 2)
+    triangles = isosurface_triangles(r, (x, x, x), 1.0)
+    np.testing.assert_allclose(np.linalg.norm(triangles, axis=2), 1.0, atol=5.0E-3)
+    area = 0.5 * np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]), axis=1)
+    np.testing.assert_allclose(area.sum(), 4 * np.pi, rtol=5.0E-3)
+    assert isosurface_triangles(r, (x, x, x), 10.0).shape == (0, 3, 3)
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+from fluka_data import USRBINData, write_usrbins_binary
+from fluka_batch import load_config
+from fluka_watch import CycleWatcher
+
+
+BINS = [[0.0, 100.0, 20, 5.0], [0.0, 10.0, 4, 2.5], [0.0, 10.0, 3, 10.0 / 3]]
+
+
+def cycle(scale):
+    x = np.linspace(2.5, 97.5, 20)
+    data = scale * 1.0E-2 * np.exp(-0.05 * np.maximum(x - 50.0, 0.0))[:, None, None] * np.ones((20, 4, 3))
+    return [USRBINData(BINS, data, np.full(data.shape, 5.0), name='DOSE', particle=240)]
+
+
+def drop(directory, name, scale):
+    # written aside and renamed, as a finished cycle lands
+    tmp = os.path.join(directory, '.tmp')
+    write_usrbins_binary(tmp, cycle(scale))
+    os.replace(tmp, os.path.join(directory, name))
+
+
+def watcher(tmp_path):
+    config = load_config()
+    config.update({'norm': 1.0, 'target_dose': 1.0E-4, 'walls': {'X': [0, 50.0]},
+                   'symmetry': None, 'slices': [[1, 1]]})
+    return CycleWatcher(str(tmp_path), config, out_dir=str(tmp_path / 'out'), settle=0)
+
+
+def test_new_file_is_merged(tmp_path):
+    w = watcher(tmp_path)
+    assert w.poll() == []
+    drop(str(tmp_path), 'run001_fort.21', 1.0)
+    drop(str(tmp_path), 'run002_fort.21', 3.0)
+    assert [os.path.basename(fn) for fn in w.poll()] == ['run001_fort.21', 'run002_fort.21']
+    p = w.products
+    assert p['nruns'] == 2
+    np.testing.assert_allclose(p['merged'].data, cycle(2.0)[0].data, rtol=1.0E-6)
+    thickness, failed = p['thickness']['X']
+    assert np.all(np.isfinite(thickness)) and not failed.any()
+    assert os.path.exists(str(tmp_path / 'out' / 'status.json'))
+
+
+def test_merged_file_is_skipped(tmp_path):
+    w = watcher(tmp_path)
+    drop(str(tmp_path), 'run001_fort.21', 1.0)
+    assert len(w.poll()) == 1
+    # touched, not re-read
+    os.utime(str(tmp_path / 'run001_fort.21'))
+    assert w.poll() == []
+    assert w.merge.nruns == 1
+
+
+def test_bad_file_is_retried(tmp_path):
+    w = watcher(tmp_path)
+    drop(str(tmp_path), 'run001_fort.21', 1.0)
+    w.poll()
+    empty = str(tmp_path / 'run002_fort.21')
+    open(empty, 'wb').close()
+    with open(str(tmp_path / 'run001_fort.21'), 'rb') as f:
+        head = f.read(300)
+    truncated = str(tmp_path / 'run003_fort.21')
+    with open(truncated, 'wb') as f:
+        f.write(head)
+    assert w.poll() == []
+    assert sorted(w.failed) == [empty, truncated]
+    # unchanged bad files are not read again
+    assert w.poll() == []
+    drop(str(tmp_path), 'run002_fort.21', 2.0)
+    drop(str(tmp_path), 'run003_fort.21', 3.0)
+    assert len(w.poll()) == 2
+    assert w.failed == {}
+    assert w.merge.nruns == 3
+    np.testing.assert_allclose(w.products['merged'].data, cycle(2.0)[0].data, rtol=1.0E-6)
@@ -0,0 +1,95 @@
+import os
+import json
+import threading
+import http.server
+from time import monotonic
+import pytest
+from main_ import TORI_Crawler
+
+
+PAGES = {'550134': b'<html><body>Cs134</body></html>',
+         '270060': b'<html><body>Co60</body></html>',
+         '531310': b'<html><body>I131</body></html>'}
+
+
+class TORIServer(http.server.ThreadingHTTPServer):
+    """Stand-in TORI site: saved pages, 404 for unknown codes, 503 answers on demand."""
+    def __init__(self):
+        super(TORIServer, self).__init__(('127.0.0.1', 0), TORIHandler)
+        self.hits = {}
+        self.times = []
+        self.unavailable = {}  # code: number of 503 answers before the page
+        self.lock = threading.Lock()
+
+
+class TORIHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        iza = self.path.split('=')[-1]
+        with server.lock:
+            server.hits[iza] = server.hits.get(iza, 0) + 1
+            server.times.append(monotonic())
+            busy = server.unavailable.get(iza, 0)
+            if busy:
+                server.unavailable[iza] = busy - 1
+        if busy:
+            status, body = 503, b''
+        elif iza in PAGES:
+            status, body = 200, PAGES[iza]
+        else:
+            status, body = 404, b'not found'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    srv = TORIServer()
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def crawler(server, out_dir, **kwargs):
+    url = 'http://127.0.0.1:%s/toi/nuclide.asp?iZA=%%s' % server.server_port
+    return TORI_Crawler(str(out_dir), url=url, backoff=0.01, timeout=5.0, **kwargs)
+
+
+def test_crawl_retries_and_checkpoint(server, tmp_path):
+    server.unavailable['531310'] = 1
+    rate = 20.0
+    c = crawler(server, tmp_path, max_workers=4, rate=rate, retries=2)
+    assert c.crawl([550134, 270060, 531310, 10001]) == []
+    # the transient 503 was retried, every other code fetched once
+    assert server.hits == {'550134': 1, '270060': 1, '531310': 2, '10001': 1}
+    # requests of all threads together respect the rate limit
+    times = sorted(server.times)
+    assert min(b - a for a, b in zip(times, times[1:])) > 0.5 / rate
+    with open(str(tmp_path / 'checkpoint.json')) as f:
+        assert json.load(f) == {'550134': 200, '270060': 200, '531310': 200, '10001': 404}
+    for iza, page in PAGES.items():
+        with open(str(tmp_path / ('%s.html' % iza)), 'rb') as f:
+            assert f.read() == page
+    assert not os.path.exists(str(tmp_path / '10001.html'))
+
+
+def test_crawl_resumes(server, tmp_path):
+    # 531310 stays unavailable through all the attempts of the first crawl
+    server.unavailable['531310'] = 2
+    c = crawler(server, tmp_path, rate=50.0, retries=1)
+    assert c.crawl([550134, 531310]) == [531310]
+    with open(str(tmp_path / 'checkpoint.json')) as f:
+        assert json.load(f) == {'550134': 200}
+    # a new crawler picks up the checkpoint: only the missing codes are fetched
+    c = crawler(server, tmp_path, rate=50.0, retries=1)
+    assert c.crawl([550134, 531310, 270060]) == []
+    assert server.hits == {'550134': 1, '531310': 3, '270060': 1}
+    with open(str(tmp_path / 'checkpoint.json')) as f:
+        assert json.load(f) == {'550134': 200, '531310': 200, '270060': 200}
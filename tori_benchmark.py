@@ -0,0 +1,56 @@
+import sys
+import glob
+import os
+from time import time
+import numpy as np
+from main_ import TORI_Record, TORI_DB
+
+
+def load_pages(path):
+    pages = []
+    for fn in sorted(glob.glob(os.path.join(path, '*.html'))):
+        with open(fn, 'rb') as f:
+            pages.append((fn, f.read()))
+    return pages
+
+
+def same_record(slow, fast):
+    for key in ('gamma', 'xray', 'beta'):
+        a = getattr(slow, key)
+        b = getattr(fast, key)
+        if len(a) != len(b):
+            return False
+        if len(a) and not (np.allclose([l[0] for l in a], b['energy']) and
+                           np.allclose([l[1] for l in a], b['intensity']) and
+                           [l[2] for l in a] == list(b['mode'])):
+            return False
+    return (slow.half_life == fast.half_life and slow.name == fast.name and
+            TORI_DB.to_int(slow.charge) == fast.charge and TORI_DB.to_int(slow.mass) == fast.mass)
+
+
+def main(path, repeat=3):
+    pages = load_pages(path)
+    if not pages:
+        print("No *.html pages in '%s'" % path)
+        return
+    times = {}
+    for fast in (False, True):
+        best = None
+        for i in range(repeat):
+            t0 = time()
+            records = [TORI_Record(fn, html=html, fast=fast) for fn, html in pages]
+            dt = time() - t0
+            best = dt if best is None else min(best, dt)
+        times[fast] = (best, records)
+    mismatch = [fn for (fn, html), slow, fast in zip(pages, times[False][1], times[True][1])
+                if not same_record(slow, fast)]
+    nbytes = sum(len(html) for fn, html in pages)
+    print('%s pages, %.1f kB' % (len(pages), nbytes / 1.0E+3))
+    print('%-14s %10s %10s' % ('parser', 'total, s', 'pages/s'))
+    for fast, name in ((False, 'BeautifulSoup'), (True, 'fast')):
+        print('%-14s %10.4f %10.1f' % (name, times[fast][0], len(pages) / times[fast][0]))
+    print('speedup %.1fx, mismatching pages: %s' % (times[False][0] / times[True][0], mismatch or 'none'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else '.')
@@ -0,0 +1,305 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from fluka_data import ascii2lines, USRBIN, USRBINData, get_usrbins
+from fluka_plots import dose_job, render
+
+
+if __name__ == '__main__':
+    #path = "/home/apatapenka/NorthStar/fluka_simulations/Layout_radiation_protection/NorthStar_design_vault/30kev_treshold/"
+    #fn = "simple_vault_ns_concr_local_40.bnn.lis"
+    fn = "simple_vault_ns_concr_local_30.bnn.lis"
+    #fn = "simple_vault_ns_30.bnn.lis"
+    #fn = os.path.join(path, fn)
+
+    data_ = get_usrbins(fn)
+    bins = data_[0].bins
+    x = np.linspace(bins[0][0], bins[0][1], bins[0][2])
+    y = np.linspace(bins[1][0], bins[1][1], bins[1][2])
+    z = np.linspace(bins[2][0], bins[2][1], bins[2][2])
+    #print(bins)
+
+    from scipy.optimize import curve_fit
+
+    def exp_f(x, a, b):
+        return a * np.exp(b * x)
+
+    #x = np.linspace(0,4,50)
+    #y = exp_f(x, 2.5, 1.3)
+    #yn = y + 0.2*np.random.normal(size=len(x))
+    #p0 = [1, 1]
+    #popt, pcov = curve_fit(exp_f, x, yn, p0=p0)
+    #print(popt, pcov)
+
+    ##################
+    # X = 0; I = 18
+    # Y = 0; I = 4
+    # walls : X = 203:433  cm
+    #         Z = 861:1091 cm
+    ##################
+
+    norm = (1.2E+5/4.0E+7)*6.2415E+18*1.0E-12*3600
+
+    data = data_[0].data * norm
+    data = data + np.flip(data, 2)
+
+    ax = plt.figure()
+    plt.imshow(np.log10(np.sum(data,1)))
+
+    """
+    ##################################################
+    #
+    # Prompt doses YZ
+    #
+    ##################################################
+
+
+    # i_y = 4  # 0-10
+    # i_z = 17 # 0-108
+
+    W = np.zeros((108, 18))
+    W = W + 2.3
+    lambda_coeff = []
+    for i_y in range(0, 18):
+        for i_z in range(0, 108):
+
+            inds = np.where(x > 203)
+            yd = data[:, i_y, i_z][inds]
+            xd = x[inds]
+            Dose_after_wall = yd[-1]
+            Dose_desired = 5.0E-5
+
+            if Dose_after_wall > Dose_desired:
+
+                a, b = np.polyfit(xd, np.log(yd), 1, w=np.sqrt(yd))
+
+                a,b = np.polyfit(xd, np.log(yd), 1) #, w=np.sqrt(yd))
+                y_a = a*xd + b
+                yd_a = np.exp(a*xd + b)
+
+                # errors :
+                mx = np.average(xd)
+                my = np.average(yd)
+                Dyy = np.sum((np.log(yd) - np.average(np.log(yd)))**2)
+                Dxx = np.sum((xd - np.average(xd))**2)
+                sk = np.sqrt(1/(len(xd)-2) * (Dyy/Dxx - a**2))
+
+
+                inds = np.where( x < 203)
+                Dose_ = data[:, i_y, i_z][inds]
+                Dose_0 = Dose_[-1]
+                #print('Dose inner wall ', Dose_0)
+
+                a_min = a + np.abs(1*sk)
+                Thickness = -(np.log(Dose_0) - np.log(Dose_desired))/a_min
+
+
+                try:
+                    Thickness = float(Thickness)
+                    W[i_z, i_y] = Thickness /100
+                    print('Wall thickness: %s, decay parameter: %s +- %s' % (round(Thickness), a * 100, np.abs(sk * 2) * 100))
+                    lambda_coeff.append(a_min)
+                except Exception:
+                    print(i_z, i_y)
+                #else:
+                    #W[i_x, i_y] = 2.3
+                    #print('Normalno: ', i_x, i_y)
+    #plt.imshow(W.T)
+    # for seaborn
+    W = W.T
+    W = np.flip(W,0)
+
+
+    import seaborn
+    import seaborn as sns
+    import pandas as pd
+
+    dd = data[-1,:,:]
+    dd = np.flip(dd, 0)
+    df = pd.DataFrame(dd)
+    plt.figure()
+    ax = sns.heatmap(W, annot=True, yticklabels=np.round(np.flip(y)), xticklabels=np.round(z), cbar_kws={"label": "Required wall thickness, m"})
+    ax.figure.axes[-1].yaxis.label.set_size(16)
+    ax.set_xlabel('Z')
+    ax.set_ylabel('Y')
+    ax.xaxis.label.set_size(18)
+    ax.yaxis.label.set_size(18)
+    #plt.xticks(x)
+    #plt.yticks(y)
+
+    ax = plt.figure()
+    ax = sns.heatmap(dd*1.0E+6, yticklabels=np.round(np.flip(y)), xticklabels=np.round(z),
+                     cbar_kws={"label": " \u03BCSv/h"})
+    ax.figure.axes[-1].yaxis.label.set_size(16)
+    ax.set_xlabel('Z')
+    ax.set_ylabel('Y')
+    ax.xaxis.label.set_size(18)
+    ax.yaxis.label.set_size(18)
+    #ax.set_yticks(y)
+    #sns.heatmap(dd, annot=False, cbar_kws={"label": " \u03BCSv/h"})
+
+
+    print('Wall thickness: ', (W))
+    print('Lambda koeff.: ', np.max(lambda_coeff), np.min(lambda_coeff))
+
+    #plt.semilogy(xd, yd) #/np.max(yd))
+
+    #plt.semilogy(xd, yd)
+    #plt.semilogy(xd, yd_a)
+
+    #plt.plot(xd, a + b*xd)
+
+    #print(yd/np.max(yd), yd_a)
+    #plt.show()
+    """
+
+
+    """
+    ##################################################
+    #
+    # Prompt doses XY
+    #
+    ##################################################
+
+
+    # i_y = 4  # 0-10
+    # i_x = 17 # 8-20
+
+    W = np.zeros((40, 18))
+    W = W + 2.3
+    lambda_coeff = []
+    for i_y in range(0, 18):
+        for i_x in range(0, 40):
+
+            inds = np.where(z > 861)
+            yd = data[i_x, i_y, :][inds]
+            xd = z[inds]
+            Dose_after_wall = yd[-1]
+            Dose_desired = 5.0E-5
+
+            if Dose_after_wall > Dose_desired:
+
+                a, b = np.polyfit(xd, np.log(yd), 1, w=np.sqrt(yd))
+
+                a,b = np.polyfit(xd, np.log(yd), 1) #, w=np.sqrt(yd))
+                y_a = a*xd + b
+                yd_a = np.exp(a*xd + b)
+
+                # errors :
+                mx = np.average(xd)
+                my = np.average(yd)
+                Dyy = np.sum((np.log(yd) - np.average(np.log(yd)))**2)
+                Dxx = np.sum((xd - np.average(xd))**2)
+                sk = np.sqrt(1/(len(xd)-2) * (Dyy/Dxx - a**2))
+
+
+                inds = np.where( z < 861)
+                Dose_ = data[i_x, i_y, :][inds]
+                Dose_0 = Dose_[-1]
+                #print('Dose inner wall ', Dose_0)
+
+                a_min = a + np.abs(1*sk)
+                Thickness = -(np.log(Dose_0) - np.log(Dose_desired))/a_min
+
+
+                try:
+                    Thickness = float(Thickness)
+                    W[i_x, i_y] = Thickness /100
+                    print('Wall thickness: %s, decay parameter: %s +- %s' % (round(Thickness), a * 100, np.abs(sk * 2) * 100))
+                    lambda_coeff.append(a_min)
+                except Exception:
+                    print(i_x, i_y)
+                #else:
+                    #W[i_x, i_y] = 2.3
+                    #print('Normalno: ', i_x, i_y)
+
+
+    #plt.imshow(W.T)
+    # for seaborn
+    W = W.T
+    W = np.flip(W,0)
+
+
+    import seaborn
+    import seaborn as sns
+    import pandas as pd
+
+    dd = data[:,:,-1].T
+    dd = np.flip(dd, 0)
+    df = pd.DataFrame(dd)
+    plt.figure()
+    ax = sns.heatmap(W, annot=True, yticklabels=np.round(np.flip(y)), xticklabels=np.round(x), cbar_kws={"label": "Required wall thickness, m"})
+    ax.figure.axes[-1].yaxis.label.set_size(16)
+    ax.set_xlabel('X')
+    ax.set_ylabel('Y')
+    ax.xaxis.label.set_size(18)
+    ax.yaxis.label.set_size(18)
+    #plt.xticks(x)
+    #plt.yticks(y)
+
+    ax = plt.figure()
+    ax = sns.heatmap(dd*1.0E+6, yticklabels=np.round(np.flip(y)), xticklabels=np.round(x),
+                     cbar_kws={"label": " \u03BCSv/h"})
+    ax.figure.axes[-1].yaxis.label.set_size(16)
+    ax.set_xlabel('X')
+    ax.set_ylabel('Y')
+    ax.xaxis.label.set_size(18)
+    ax.yaxis.label.set_size(18)
+    #ax.set_yticks(y)
+    #sns.heatmap(dd, annot=False, cbar_kws={"label": " \u03BCSv/h"})
+
+
+    print('Wall thickness: ', (W))
+    print('Lambda koeff.: ', np.max(lambda_coeff), np.min(lambda_coeff))
+
+    #plt.semilogy(xd, yd) #/np.max(yd))
+
+    #plt.semilogy(xd, yd)
+    #plt.semilogy(xd, yd_a)
+
+    #plt.plot(xd, a + b*xd)
+
+    #print(yd/np.max(yd), yd_a)
+    #plt.show()
+    """
+
+    ##################################################
+    #
+    # Residual doses
+    #
+    ##################################################
+
+
+    fn = "simple_vault_ns_concr_local_40.bnn.lis"
+    fn = "simple_vault_ns_40.bnn.lis"
+
+    lines = ascii2lines(fn=fn)
+    usrbin = USRBIN(lines)
+    usrbin.get_bins()
+
+    print(usrbin.bins)
+    #print(usrbin.errors)
+
+
+
+    data_ = get_usrbins(fn)
+
+    jobs = []
+    for index in range(5):
+        usrbin = data_[index]
+        data = usrbin.data + np.flip(usrbin.data, 2)
+        # Y = 0, dose: Sv/hour
+        jobs.append(dose_job(USRBINData(usrbin.bins, data, usrbin.errors), (1, 4),
+                             fn + '_' + str(index) + '.jpg', norm=3600*1.0E-12,
+                             rect=(-861, -203, 861*2, 203*2)))
+    render(jobs)
+
+
+    plt.show()
+
+    #print(np.max(data_[0].data) / np.max(data_[0].data),
+    #      np.max(data_[1].data) / np.max(data_[0].data),
+    #      np.max(data_[2].data) / np.max(data_[0].data),
+    #      np.max(data_[3].data) / np.max(data_[0].data),
+    #      np.max(data_[4].data) / np.max(data_[0].data))
+
+    #print(data_[4].bins)